@@ -0,0 +1,233 @@
+"""An in-memory cache of answers, with lookup by query text or query embedding."""
+import collections
+import json
+import re
+import threading
+import time
+
+CONFIG = {
+    "MAX_ENTRIES": 1024,  # least-recently-used answers are evicted beyond this
+    "TTL_SECONDS": 24 * 60 * 60,  # answers older than this are never returned
+    "SIMILARITY_THRESHOLD": 0.97,  # minimum cosine similarity for a semantic hit
+}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_answer_cache(index_name, filter=None, prompt_variant=None, rerank=None):
+    """Returns the container-resident answer cache for a vector index.
+
+    Answers drawn from a filtered search are cached apart from the rest, with one
+    cache per distinct filter. Answers from different prompt variants, or with and
+    without reranking, are also cached apart, as their sources and text differ.
+    """
+    key = (
+        index_name,
+        json.dumps(filter, sort_keys=True) if filter else None,
+        prompt_variant,
+        rerank,
+    )
+    with _caches_lock:
+        if not _caches:
+            import monitoring
+
+            monitoring.register_collector("answer_cache", stats)
+        if key not in _caches:
+            _caches[key] = AnswerCache()
+        return _caches[key]
+
+
+def stats():
+    """Reports the sizes and hit and miss counts summed over all answer caches."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    totals = {"entries": 0, "hits_exact": 0, "hits_semantic": 0, "misses": 0}
+    for cache in caches:
+        for key, value in cache.stats().items():
+            if key in totals:
+                totals[key] += value
+    hits = totals["hits_exact"] + totals["hits_semantic"]
+    total = hits + totals["misses"]
+    totals["hit_rate"] = hits / total if total else 0.0
+    return totals
+
+
+def normalize(query):
+    """Normalizes query text so that trivially different queries share a key."""
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+class AnswerCache:
+    """Caches answers keyed on normalized query text, with a semantic fallback.
+
+    Exact matches are found by normalized text. Otherwise, the query embedding is
+    compared against the embeddings of cached queries with a FAISS inner-product
+    index, and the closest cached answer is returned if it is similar enough.
+
+    The cache is tied to a version of the vector index: looking up or storing an
+    answer with a different version empties the cache first.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, threshold=None):
+        self.max_entries = max_entries or CONFIG["MAX_ENTRIES"]
+        self.ttl = ttl or CONFIG["TTL_SECONDS"]
+        self.threshold = threshold or CONFIG["SIMILARITY_THRESHOLD"]
+
+        self.hits = collections.Counter()
+        self.misses = 0
+        self.version = None
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> entry, in LRU order
+        self._keys_by_id = {}  # FAISS id -> key
+        self._next_id = 0
+        self._index = None
+
+    def lookup(self, query, embed_query=None, version=None):
+        """Looks up a cached answer for a query.
+
+        Arguments:
+            query: The query text.
+            embed_query: A function that embeds the query text. If provided and there
+                is no exact match, it is used for a semantic lookup.
+            version: The version of the vector index that answers are drawn from.
+
+        Returns:
+            A tuple of the cached entry, or None on a miss, and the query embedding,
+            or None if the query was not embedded.
+        """
+        entry = self._lookup_exact(query, version)
+        if entry is not None:
+            return entry, None
+
+        if embed_query is None:
+            self.misses += 1
+            return None, None
+
+        embedding = embed_query(query)
+        return self._lookup_similar(embedding), embedding
+
+    async def alookup(self, query, aembed_query=None, version=None):
+        """Looks up a cached answer like lookup, embedding the query asynchronously.
+
+        Arguments:
+            aembed_query: A coroutine function that embeds the query text.
+        """
+        entry = self._lookup_exact(query, version)
+        if entry is not None:
+            return entry, None
+
+        if aembed_query is None:
+            self.misses += 1
+            return None, None
+
+        embedding = await aembed_query(query)
+        return self._lookup_similar(embedding), embedding
+
+    def store(self, query, answer, sources, embedding=None, version=None):
+        """Adds an answer, and the sources it was drawn from, to the cache."""
+        key = normalize(query)
+        with self._lock:
+            self._check_version(version)
+            if key in self._entries:
+                self._remove(key)
+
+            entry = {"answer": answer, "sources": sources, "created_at": time.time()}
+            if embedding is not None:
+                entry["id"] = self._add_embedding(embedding, key)
+            self._entries[key] = entry
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self):
+        """Empties the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+            self._index = None
+
+    def stats(self):
+        """Reports the size of the cache and its hit and miss counts."""
+        hits = sum(self.hits.values())
+        total = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits_exact": self.hits["exact"],
+            "hits_semantic": self.hits["semantic"],
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+    def _lookup_exact(self, query, version):
+        with self._lock:
+            self._check_version(version)
+            entry = self._get(normalize(query))
+        if entry is not None:
+            self.hits["exact"] += 1
+        return entry
+
+    def _lookup_similar(self, embedding):
+        with self._lock:
+            entry = self._get_similar(embedding)
+        if entry is not None:
+            self.hits["semantic"] += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self._keys_by_id.clear()
+            self._index = None
+            self.version = version
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created_at"] > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _get_similar(self, embedding):
+        if self._index is None or self._index.ntotal == 0:
+            return None
+        scores, ids = self._index.search(_as_unit_vector(embedding), 1)
+        score, id_ = float(scores[0][0]), int(ids[0][0])
+        if id_ < 0 or score < self.threshold:
+            return None
+        return self._get(self._keys_by_id[id_])
+
+    def _add_embedding(self, embedding, key):
+        import faiss
+        import numpy as np
+
+        vector = _as_unit_vector(embedding)
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+        id_ = self._next_id
+        self._next_id += 1
+        self._index.add_with_ids(vector, np.array([id_], dtype="int64"))
+        self._keys_by_id[id_] = key
+        return id_
+
+    def _remove(self, key):
+        import numpy as np
+
+        entry = self._entries.pop(key)
+        if "id" in entry:
+            self._keys_by_id.pop(entry["id"], None)
+            self._index.remove_ids(np.array([entry["id"]], dtype="int64"))
+
+
+def _as_unit_vector(embedding):
+    import numpy as np
+
+    vector = np.asarray(embedding, dtype="float32").reshape(1, -1)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
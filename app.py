@@ -1,9 +1,11 @@
 """Builds a CLI, Webhook, and Gradio app for Q&A on the Full Stack corpus.
 
 For details on corpus construction, see the accompanying notebook."""
+import os
+
 import modal
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, RedirectResponse
 
 import vecstore
 from utils import pretty_log
@@ -11,23 +13,34 @@ from utils import pretty_log
 
 # definition of our container image for jobs on Modal
 # Modal gets really powerful when you start using multiple images!
-image = modal.Image.debian_slim(  # we start from a lightweight linux distro
-    python_version="3.10"  # we add a recent Python version
-).pip_install(  # and we install the following packages:
-    "langchain==0.0.184",
-    # 🦜🔗: a framework for building apps with LLMs
-    "openai~=0.27.7",
-    # high-quality language models and cheap embeddings
-    "tiktoken",
-    # tokenizer for OpenAI models
-    "faiss-cpu",
-    # vector storage and similarity search
-    "pymongo[srv]==3.11",
-    # python client for MongoDB, our data persistence solution
-    "gradio~=3.34",
-    # simple web UIs in Python, from 🤗
-    "gantry==0.5.6",
-    # 🏗️: monitoring, observability, and continual improvement for ML systems
+image = (
+    modal.Image.debian_slim(  # we start from a lightweight linux distro
+        python_version="3.10"  # we add a recent Python version
+    )
+    .pip_install(  # and we install the following packages:
+        "langchain==0.0.184",
+        # 🦜🔗: a framework for building apps with LLMs
+        "openai~=0.27.7",
+        # high-quality language models and cheap embeddings
+        "tiktoken",
+        # tokenizer for OpenAI models
+        "faiss-cpu",
+        # vector storage and similarity search
+        "pymongo[srv]==3.11",
+        # python client for MongoDB, our data persistence solution
+        "gradio~=3.34",
+        # simple web UIs in Python, from 🤗
+        "gantry==0.5.6",
+        # 🏗️: monitoring, observability, and continual improvement for ML systems
+    )
+    .pip_install(  # CPU-only builds of PyTorch are much smaller than the default
+        "torch~=2.0.1",
+        index_url="https://download.pytorch.org/whl/cpu",
+    )
+    .pip_install(
+        "sentence-transformers~=2.2.2",
+        # cross-encoders for reranking, if RERANK_MODEL names one
+    )
 )
 
 # we define a Stub to hold all the pieces of our app
@@ -40,16 +53,41 @@ stub = modal.Stub(
         modal.Secret.from_name("mongodb-fsdl"),
         modal.Secret.from_name("openai-api-key-fsdl"),
         modal.Secret.from_name("gantry-api-key-fsdl"),
+        # the index and prompt to serve are chosen on the machine that deploys the app
+        modal.Secret.from_dict(
+            {
+                "VECTOR_INDEX_NAME": vecstore.INDEX_NAME,
+                "PROMPT_VARIANT": os.environ.get("PROMPT_VARIANT", "main"),
+                "RERANK": os.environ.get("RERANK", "false"),
+                "RERANK_MODEL": os.environ.get("RERANK_MODEL", "hybrid"),
+            }
+        ),
     ],
     mounts=[
         # we make our local modules available to the container
         modal.Mount.from_local_python_packages(
-            "vecstore", "docstore", "utils", "prompts"
+            "vecstore",
+            "docstore",
+            "utils",
+            "prompts",
+            "answercache",
+            "embedder",
+            "monitoring",
+            "packing",
+            "sparse",
+            "filters",
+            "chunkstore",
+            "reranking",
         )
     ],
 )
 
 VECTOR_DIR = vecstore.VECTOR_DIR
+BUILD_CPUS = 8  # cores for vector index builds, which split text in parallel
+DOCUMENT_BATCH_SIZE = 1000  # number of documents fetched per round trip to the store
+DOCUMENT_READ_WORKERS = 4  # ranges of the document store read in parallel for builds
+MAX_CONCURRENT_QUESTIONS = 32  # questions in flight at once in each serving container
+BATCH_CONTAINERS = 8  # containers generating answers at once for batch Q&A
 vector_storage = modal.NetworkFileSystem.persisted("vector-vol")
 
 
@@ -58,20 +96,80 @@ vector_storage = modal.NetworkFileSystem.persisted("vector-vol")
     network_file_systems={
         str(VECTOR_DIR): vector_storage,
     },
+    allow_concurrent_inputs=MAX_CONCURRENT_QUESTIONS,
 )
 @modal.web_endpoint(method="GET")
-def web(query: str, request_id=None):
-    """Exposes our Q&A chain for queries via a web endpoint."""
-    import os
-
+async def web(
+    query: str,
+    request_id=None,
+    stream: bool = False,
+    source_type: str = None,
+    title: str = None,
+    rerank: bool = None,
+    prompt_variant: str = None,
+):
+    """Exposes our Q&A chain for queries via a web endpoint.
+
+    With stream set, the answer is sent token-by-token as server-sent events.
+
+    Sources can be restricted to one of filters.SOURCE_TYPES, like "video",
+    "paper" or "lecture", and to those whose title contains the given title.
+    Unknown source types are rejected with a 400 error.
+
+    With rerank set, or unset, retrieved chunks are or aren't reranked before
+    they're put in the prompt. By default, the RERANK setting of the deployment.
+
+    The prompt can be set to one of prompts.VARIANTS, by default PROMPT_VARIANT.
+    Unknown variants are also rejected with a 400 error.
+    """
     pretty_log(
         f"handling request with client-provided id: {request_id}"
     ) if request_id else None
 
-    answer = qanda.remote(
+    from filters import SOURCE_TYPES
+
+    source_type = source_type and source_type.strip().lower()
+    if source_type and source_type not in SOURCE_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"unknown source_type {source_type}, try one of {SOURCE_TYPES}",
+        )
+
+    from prompts import VARIANTS
+
+    if prompt_variant and prompt_variant not in VARIANTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"unknown prompt_variant {prompt_variant},"
+            f" try one of {list(VARIANTS)}",
+        )
+
+    with_logging = bool(os.environ.get("GANTRY_API_KEY"))
+    filters = {"source_type": source_type, "title": title}
+    filters = {field: value for field, value in filters.items() if value} or None
+
+    if stream:
+        from fastapi.responses import StreamingResponse
+
+        tokens = stream_qanda(
+            query,
+            request_id=request_id,
+            with_logging=with_logging,
+            filters=filters,
+            rerank=rerank,
+            prompt_variant=prompt_variant,
+        )
+        return StreamingResponse(
+            to_server_sent_events(tokens), media_type="text/event-stream"
+        )
+
+    answer = await qanda.remote.aio(
         query,
         request_id=request_id,
-        with_logging=bool(os.environ.get("GANTRY_API_KEY")),
+        with_logging=with_logging,
+        filters=filters,
+        rerank=rerank,
+        prompt_variant=prompt_variant,
     )
     return {"answer": answer}
 
@@ -82,60 +180,302 @@ def web(query: str, request_id=None):
         str(VECTOR_DIR): vector_storage,
     },
     keep_warm=1,
+    allow_concurrent_inputs=MAX_CONCURRENT_QUESTIONS,
 )
-def qanda(query: str, request_id=None, with_logging: bool = False) -> str:
+async def qanda(
+    query: str,
+    request_id=None,
+    with_logging: bool = False,
+    nprobe: int = None,
+    ef_search: int = None,
+    prompt_variant: str = None,
+    filters: dict = None,
+    rerank: bool = None,
+) -> str:
     """Runs sourced Q&A for a query using LangChain.
 
     Arguments:
         query: The query to run Q&A on.
         request_id: A unique identifier for the request.
         with_logging: If True, logs the interaction to Gantry.
+        nprobe: For IVF indexes, how many lists to search. Higher is slower but
+            has better recall.
+        ef_search: For HNSW indexes, how many candidates to keep while searching.
+            Higher is slower but has better recall.
+        prompt_variant: The name of the prompt to use, from prompts.VARIANTS.
+            By default, the PROMPT_VARIANT of the deployment.
+        filters: Restricts sources to those with matching metadata, e.g.
+            {"source_type": "paper"}. See filters.FIELDS for the fields.
+        rerank: If True, more chunks are retrieved and reranked, and only the best
+            are packed into the prompt. By default, reranking.CONFIG["ENABLED"].
     """
-    from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-    from langchain.chat_models import ChatOpenAI
+    import monitoring
+    import prompts
+
+    prompts.get_prompt(prompt_variant)  # fails fast on unknown variants
+    trace = monitoring.Trace(
+        request_id, streaming=False, prompt_variant=prompt_variant, filters=filters
+    )
+    cache = get_answer_cache(filters, prompt_variant, rerank)
+    answer, sources, query_embedding = await retrieve(
+        query, trace, cache, nprobe, ef_search, filters, rerank
+    )
+
+    if answer is None:
+        pretty_log("running query against Q&A chain")
+        chain = get_chain(
+            verbose=with_logging,
+            callbacks=[monitoring.llm_timer(trace)],
+            prompt_variant=prompt_variant,
+        )
+        result = await chain.acall(
+            {"input_documents": sources, "question": query}, return_only_outputs=True
+        )
+        answer = result["output_text"]
+
+    await finish(
+        query,
+        answer,
+        sources,
+        query_embedding,
+        request_id,
+        with_logging,
+        trace,
+        cache,
+    )
 
+    return answer
+
+
+async def stream_qanda(
+    query: str,
+    request_id=None,
+    with_logging: bool = False,
+    nprobe: int = None,
+    ef_search: int = None,
+    prompt_variant: str = None,
+    filters: dict = None,
+    rerank: bool = None,
+):
+    """Runs sourced Q&A for a query, yielding the answer as the LLM generates it.
+
+    Takes the same arguments as qanda. Cached answers are yielded all at once.
+    """
+    import asyncio
+
+    import monitoring
     import prompts
-    import vecstore
 
-    embedding_engine = vecstore.get_embedding_engine(allowed_special="all")
+    prompts.get_prompt(prompt_variant)  # fails fast on unknown variants
+    trace = monitoring.Trace(
+        request_id, streaming=True, prompt_variant=prompt_variant, filters=filters
+    )
+    cache = get_answer_cache(filters, prompt_variant, rerank)
+    answer, sources, query_embedding = await retrieve(
+        query, trace, cache, nprobe, ef_search, filters, rerank
+    )
+
+    if answer is not None:
+        yield answer
+    else:
+        pretty_log("streaming query against Q&A chain")
+        tokens = asyncio.Queue()
+        chain = get_chain(
+            verbose=with_logging,
+            callbacks=[on_token(tokens), monitoring.llm_timer(trace)],
+            streaming=True,
+            prompt_variant=prompt_variant,
+        )
+        run = asyncio.ensure_future(
+            chain.acall(
+                {"input_documents": sources, "question": query},
+                return_only_outputs=True,
+            )
+        )
+        run.add_done_callback(lambda _: tokens.put_nowait(None))
+
+        try:
+            while (token := await tokens.get()) is not None:
+                yield token
+        finally:
+            if not run.done():  # the client went away, so stop generating
+                run.cancel()
+        answer = run.result()["output_text"]
 
-    pretty_log("connecting to vector storage")
-    vector_index = vecstore.connect_to_vector_index(
-        vecstore.INDEX_NAME, embedding_engine
+    await finish(
+        query,
+        answer,
+        sources,
+        query_embedding,
+        request_id,
+        with_logging,
+        trace,
+        cache,
     )
-    pretty_log("connected to vector storage")
+
+
+async def retrieve(
+    query, trace, cache, nprobe=None, ef_search=None, filters=None, rerank=None
+):
+    """Looks up a cached answer for a query, or else retrieves sources for it.
+
+    Blocking work, like loading the index and searching it, runs in threads so that
+    other requests in the container can proceed. Each stage is timed into the trace.
+
+    Returns:
+        A tuple of the cached answer, or None, the sources, and the query
+        embedding, which is None if the answer came from the cache.
+    """
+    import asyncio
+
+    import packing
+    import reranking
+
+    # the index and embedding engine stay resident in the container between calls
+    with trace.span("index_load"):
+        vector_index = await asyncio.to_thread(
+            vecstore.get_resident_vector_index,
+            vecstore.INDEX_NAME,
+            trace=trace,
+            concurrent=True,
+        )
     pretty_log(f"found {vector_index.index.ntotal} vectors to search over")
 
+    async def embed_query(text):
+        with trace.span("query_embedding"):
+            return await vector_index.embedding_engine.aembed_query(text)
+
     pretty_log(f"running on query: {query}")
+    with trace.span("cache_lookup"):  # includes query_embedding, on a miss
+        cached, query_embedding = await cache.alookup(
+            query,
+            aembed_query=embed_query,
+            version=vecstore.get_resident_version(vecstore.INDEX_NAME),
+        )
+    pretty_log(f"answer cache stats: {cache.stats()}")
+
+    if cached is not None:
+        pretty_log("found answer in cache")
+        return cached["answer"], cached["sources"], None
+
+    rerank = reranking.CONFIG["ENABLED"] if rerank is None else rerank
+    trace.fields["rerank"] = rerank
+    candidates = reranking.CONFIG["CANDIDATES"] if rerank else None
+
     pretty_log("selecting sources by similarity to query")
-    sources_and_scores = vector_index.similarity_search_with_score(query, k=3)
+    with trace.span("search"):
+        sources_and_scores = await asyncio.to_thread(
+            vecstore.hybrid_search,
+            vector_index,
+            query_embedding,
+            query,
+            k=candidates or packing.CONFIG["CANDIDATES"],
+            nprobe=nprobe,
+            ef_search=ef_search,
+            filter=filters,
+        )
+
+    if rerank:
+        with trace.span("rerank"):
+            sources_and_scores = await asyncio.to_thread(
+                reranking.rerank,
+                query,
+                sources_and_scores,
+                vector_index.sparse_index,
+            )
+
+    with trace.span("packing"):
+        # reranked chunks have already been chosen, so aren't cut for similarity
+        sources, context_tokens = packing.pack(
+            sources_and_scores, max_gap=float("inf") if rerank else None
+        )
+    trace.add_tokens("context", context_tokens)
+    pretty_log(f"packed {len(sources)} sources into {context_tokens} tokens")
 
-    sources, scores = zip(*sources_and_scores)
+    return None, sources, query_embedding
 
-    pretty_log("running query against Q&A chain")
 
-    llm = ChatOpenAI(model_name="gpt-4", temperature=0, max_tokens=256)
+def get_answer_cache(filters=None, prompt_variant=None, rerank=None):
+    """Returns the answer cache for the settings of a request that change answers."""
+    import answercache
+    import prompts
+    import reranking
+
+    return answercache.get_answer_cache(
+        vecstore.INDEX_NAME,
+        filters,
+        prompt_variant=prompt_variant or prompts.PROMPT_VARIANT,
+        rerank=reranking.CONFIG["ENABLED"] if rerank is None else rerank,
+    )
+
+
+def get_chain(verbose=False, callbacks=None, streaming=False, prompt_variant=None):
+    """Creates the sourced Q&A chain, reporting LLM events to callbacks.
+
+    With streaming set, callbacks also receive each token as it is generated.
+    """
+    from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+    from langchain.chat_models import ChatOpenAI
+
+    import prompts
+
+    llm = ChatOpenAI(
+        model_name="gpt-4",
+        temperature=0,
+        max_tokens=256,
+        streaming=streaming,
+        callbacks=callbacks,
+    )
     chain = load_qa_with_sources_chain(
         llm,
         chain_type="stuff",
-        verbose=with_logging,
-        prompt=prompts.main,
+        verbose=verbose,
+        prompt=prompts.get_prompt(prompt_variant),
         document_variable_name="sources",
     )
 
-    result = chain(
-        {"input_documents": sources, "question": query}, return_only_outputs=True
-    )
-    answer = result["output_text"]
+    return chain
+
+
+def on_token(tokens):
+    """Creates a LangChain callback handler that puts new LLM tokens on a queue."""
+    from langchain.callbacks.base import AsyncCallbackHandler
+
+    class QueueTokens(AsyncCallbackHandler):
+        async def on_llm_new_token(self, token: str, **kwargs) -> None:
+            tokens.put_nowait(token)
+
+    return QueueTokens()
+
+
+async def finish(
+    query, answer, sources, query_embedding, request_id, with_logging, trace, cache
+):
+    """Caches a freshly-generated answer, logs the interaction and emits the trace."""
+    if query_embedding is not None:
+        cache.store(
+            query,
+            answer,
+            sources,
+            embedding=query_embedding,
+            version=vecstore.get_resident_version(vecstore.INDEX_NAME),
+        )
 
     if with_logging:
         print(answer)
-        pretty_log("logging results to gantry")
-        record_key = log_event(query, sources, answer, request_id=request_id)
-        if record_key:
-            pretty_log(f"logged to gantry with key {record_key}")
+        with trace.span("logging"):
+            log_event(query, sources, answer, request_id=request_id)
 
-    return answer
+    trace.emit(cache_hit=query_embedding is None)
+
+
+async def to_server_sent_events(tokens):
+    """Formats a stream of tokens as server-sent events, ending with a done event."""
+    import json
+
+    async for token in tokens:
+        yield f"data: {json.dumps({'token': token})}\n\n"
+    yield "event: done\ndata: {}\n\n"
 
 
 @stub.function(
@@ -143,10 +483,24 @@ def qanda(query: str, request_id=None, with_logging: bool = False) -> str:
     network_file_systems={
         str(VECTOR_DIR): vector_storage,
     },
-    cpu=8.0,  # use more cpu for vector storage creation
+    cpu=BUILD_CPUS,  # use more cpu for vector storage creation
 )
-def create_vector_index(collection: str = None, db: str = None):
-    """Creates a vector index for a collection in the document database."""
+def create_vector_index(
+    collection: str = None,
+    db: str = None,
+    incremental: bool = False,
+    index_type: str = None,
+):
+    """Creates a vector index for a collection in the document database.
+
+    With incremental set, the current index is updated in place: chunks from
+    documents whose hashes are no longer in the collection are removed and only
+    documents with new hashes are split and embedded.
+
+    The index_type, one of vecstore.INDEX_TYPES, picks exact or approximate search.
+    By default, an updated index keeps its type and a new one is
+    vecstore.DEFAULT_INDEX_TYPE. An index of another type is rebuilt.
+    """
     import docstore
 
     pretty_log("connecting to document store")
@@ -154,57 +508,119 @@ def create_vector_index(collection: str = None, db: str = None):
     pretty_log(f"connected to database {db.name}")
 
     collection = docstore.get_collection(collection, db)
-    pretty_log(f"collecting documents from {collection.name}")
-    docs = docstore.get_documents(collection, db)
 
-    pretty_log("splitting into bite-size chunks")
-    ids, texts, metadatas = prep_documents_for_vector_storage(docs)
+    embedding_engine = vecstore.get_embedding_engine(concurrent=True)
 
-    pretty_log(f"sending to vector index {vecstore.INDEX_NAME}")
-    embedding_engine = vecstore.get_embedding_engine(disallowed_special=())
-    vector_index = vecstore.create_vector_index(
-        vecstore.INDEX_NAME, embedding_engine, texts, metadatas
+    vector_index, indexed, index_params = None, set(), None
+    if incremental and vecstore.get_index_version(vecstore.INDEX_NAME):
+        vector_index = vecstore.connect_to_vector_index(
+            vecstore.INDEX_NAME, embedding_engine
+        )
+        existing_type = vector_index.manifest["index_type"]
+        if (
+            index_type in (None, existing_type)
+            and existing_type in vecstore.INDEX_TYPES
+        ):
+            # a rebuild keeps the existing index's type and parameters
+            index_type, index_params = existing_type, vector_index.manifest["params"]
+        if not vecstore.is_updatable(vector_index):
+            pretty_log(
+                f"existing {existing_type} index does not support updates,"
+                f" rebuilding it as {index_type or vecstore.DEFAULT_INDEX_TYPE}"
+            )
+            vector_index = None
+        elif index_type != existing_type:
+            pretty_log(f"existing index is not of type {index_type}, rebuilding it")
+            vector_index = None
+    index_type = index_type or vecstore.DEFAULT_INDEX_TYPE
+
+    if vector_index is not None:
+        indexed = vecstore.get_indexed_documents(vector_index).keys()
+        hashes = docstore.stream_documents(
+            collection, fields=("metadata.sha256",), as_tuples=True
+        )
+        current = {sha256 for (sha256,) in hashes}
+
+        removed = vecstore.remove_from_vector_index(vector_index, indexed - current)
+        pretty_log(
+            f"removed {removed} stale chunks, {len(current - indexed)} documents to add"
+        )
+
+    pretty_log(f"streaming documents from {collection.name} in bite-size chunks")
+    docs = docstore.stream_documents(
+        collection,
+        db,
+        batch_size=DOCUMENT_BATCH_SIZE,
+        workers=DOCUMENT_READ_WORKERS,
     )
-    vector_index.save_local(folder_path=VECTOR_DIR, index_name=vecstore.INDEX_NAME)
+    chunks = vecstore.split_documents(docs, skip=indexed, processes=BUILD_CPUS)
+
+    pretty_log(f"sending to vector index {vecstore.INDEX_NAME}")
+    if vector_index is None:
+        vector_index = vecstore.create_vector_index(
+            vecstore.INDEX_NAME,
+            embedding_engine,
+            chunks,
+            index_type=index_type,
+            index_params=index_params,
+        )
+    else:
+        added = vecstore.add_to_vector_index(vector_index, embedding_engine, chunks)
+        pretty_log(f"added {added} chunks to vector index {vecstore.INDEX_NAME}")
+
+    vecstore.save_vector_index(vector_index, vecstore.INDEX_NAME)
     pretty_log(f"vector index {vecstore.INDEX_NAME} created")
 
 
-@stub.function(image=image)
-def drop_docs(collection: str = None, db: str = None):
-    """Drops a collection from the document storage."""
+@stub.function(
+    image=image,
+    network_file_systems={
+        str(VECTOR_DIR): vector_storage,
+    },
+    cpu=BUILD_CPUS,
+)
+def snapshot_corpus(collection: str = None, db: str = None, name: str = None):
+    """Freezes the chunked corpus into a JSONL file, e.g. for benchmarks.
+
+    Download it with `modal nfs get vector-vol snapshots/NAME.jsonl .`
+    """
+    import datetime
+    import json
+
     import docstore
 
-    docstore.drop(collection, db)
+    name = name or datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    path = VECTOR_DIR / "snapshots" / f"{name}.jsonl"
+    path.parent.mkdir(parents=True, exist_ok=True)
 
+    # read in order, from one range, so that snapshots of the same corpus match
+    docs = docstore.stream_documents(collection, db, batch_size=DOCUMENT_BATCH_SIZE)
+    count = 0
+    with open(path, "w") as f:
+        for id_, text, metadata in vecstore.split_documents(docs, processes=BUILD_CPUS):
+            record = {"id": id_, "text": text, "metadata": metadata}
+            f.write(json.dumps(record, default=str) + "\n")
+            count += 1
 
-def log_event(query: str, sources, answer: str, request_id=None):
-    """Logs the event to Gantry."""
-    import os
+    pretty_log(f"wrote {count} chunks to {path}")
 
-    import gantry
 
-    if not os.environ.get("GANTRY_API_KEY"):
-        pretty_log("No Gantry API key found, skipping logging")
-        return None
+@stub.function(image=image)
+def drop_docs(collection: str = None, db: str = None):
+    """Drops a collection from the document storage, along with its ETL manifest."""
+    import docstore
 
-    gantry.init(api_key=os.environ["GANTRY_API_KEY"], environment="modal")
+    docstore.drop(collection, db)
 
-    application = "ask-fsdl"
-    join_key = str(request_id) if request_id else None
 
-    inputs = {"question": query}
-    inputs["docs"] = "\n\n---\n\n".join(source.page_content for source in sources)
-    inputs["sources"] = "\n\n---\n\n".join(
-        source.metadata["source"] for source in sources
-    )
-    outputs = {"answer_text": answer}
+def log_event(query: str, sources, answer: str, request_id=None):
+    """Queues the event for logging to Gantry in the background."""
+    import monitoring
 
-    record_key = gantry.log_record(
-        application=application, inputs=inputs, outputs=outputs, join_key=join_key
+    return monitoring.get_logging_sink().log(
+        query, sources, answer, request_id=request_id
     )
 
-    return record_key
-
 
 def prep_documents_for_vector_storage(documents):
     """Prepare documents from document store for embedding and vector storage.
@@ -214,19 +630,11 @@ def prep_documents_for_vector_storage(documents):
     Arguments:
         documents: A list of LangChain.Documents with text, metadata, and a hash ID.
     """
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-
-    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=500, chunk_overlap=100, allowed_special="all"
-    )
     ids, texts, metadatas = [], [], []
-    for document in documents:
-        text, metadata = document["text"], document["metadata"]
-        doc_texts = text_splitter.split_text(text)
-        doc_metadatas = [metadata] * len(doc_texts)
-        ids += [metadata.get("sha256")] * len(doc_texts)
-        texts += doc_texts
-        metadatas += doc_metadatas
+    for id_, text, metadata in vecstore.split_documents(documents):
+        ids.append(id_)
+        texts.append(text)
+        metadatas.append(metadata)
 
     return ids, texts, metadatas
 
@@ -243,6 +651,169 @@ def cli(query: str):
     print(answer)
 
 
+@stub.function(
+    image=image,
+    network_file_systems={
+        str(VECTOR_DIR): vector_storage,
+    },
+    timeout=60 * 60,
+)
+def qanda_batch(
+    questions: list,
+    nprobe: int = None,
+    ef_search: int = None,
+    prompt_variant: str = None,
+    filters: dict = None,
+    rerank: bool = None,
+) -> list:
+    """Runs sourced Q&A on many questions at once, e.g. for evaluations or backfills.
+
+    Questions are embedded in batches, searched for with a single matrix search of
+    the index, and packed into prompts here. Answers are then generated with
+    generate.map, at most BATCH_CONTAINERS * MAX_CONCURRENT_QUESTIONS at a time.
+    The answer cache is skipped, so every answer comes from the chain.
+
+    Takes the same arguments as qanda, other than the query and logging.
+
+    Returns:
+        A list of records, one per question, in order, with the question, the
+        answer, the sources, and the tokens of context. If generating an answer
+        failed, its record has an error instead.
+    """
+    import monitoring
+    import packing
+    import prompts
+    import reranking
+
+    prompts.get_prompt(prompt_variant)  # fails fast on unknown variants
+    rerank = reranking.CONFIG["ENABLED"] if rerank is None else rerank
+    trace = monitoring.Trace(
+        None,
+        batch_size=len(questions),
+        prompt_variant=prompt_variant,
+        filters=filters,
+        rerank=rerank,
+    )
+    with trace.span("index_load"):
+        vector_index = vecstore.get_resident_vector_index(
+            vecstore.INDEX_NAME, trace=trace, concurrent=True
+        )
+
+    pretty_log(f"embedding {len(questions)} questions")
+    with trace.span("query_embedding"):
+        embeddings = vecstore.embed_queries(vector_index.embedding_engine, questions)
+
+    pretty_log(f"searching {vector_index.index.ntotal} vectors for all questions")
+    with trace.span("search"):
+        candidates = vecstore.hybrid_search_batch(
+            vector_index,
+            embeddings,
+            questions,
+            k=reranking.CONFIG["CANDIDATES"]
+            if rerank
+            else packing.CONFIG["CANDIDATES"],
+            nprobe=nprobe,
+            ef_search=ef_search,
+            filter=filters,
+        )
+
+    if rerank:
+        with trace.span("rerank"):
+            candidates = [
+                reranking.rerank(
+                    question, sources_and_scores, vector_index.sparse_index
+                )
+                for question, sources_and_scores in zip(questions, candidates)
+            ]
+
+    with trace.span("packing"):
+        max_gap = float("inf") if rerank else None
+        packed = [
+            packing.pack(sources_and_scores, max_gap=max_gap)
+            for sources_and_scores in candidates
+        ]
+    trace.add_tokens("context", sum(tokens for _, tokens in packed))
+
+    pretty_log(f"generating {len(questions)} answers")
+    with trace.span("generation"):
+        answers = list(
+            generate.map(
+                questions,
+                [sources for sources, _ in packed],
+                kwargs={"prompt_variant": prompt_variant},
+                return_exceptions=True,
+            )
+        )
+    trace.emit(cache_hit=False)
+
+    records = []
+    for question, (sources, tokens), answer in zip(questions, packed, answers):
+        record = {
+            "question": question,
+            "sources": [source.metadata.get("source") for source in sources],
+            "context_tokens": tokens,
+        }
+        if isinstance(answer, Exception):
+            record["error"] = repr(answer)
+        else:
+            record["answer"] = answer
+        records.append(record)
+
+    failed = sum("error" in record for record in records)
+    pretty_log(f"answered {len(records) - failed} questions, {failed} failed")
+    return records
+
+
+@stub.function(
+    image=image,
+    concurrency_limit=BATCH_CONTAINERS,
+    allow_concurrent_inputs=MAX_CONCURRENT_QUESTIONS,
+)
+async def generate(query: str, sources: list, prompt_variant: str = None) -> str:
+    """Runs the Q&A chain on a query and the sources already retrieved for it."""
+    import monitoring
+
+    trace = monitoring.Trace(None, streaming=False, prompt_variant=prompt_variant)
+    chain = get_chain(
+        callbacks=[monitoring.llm_timer(trace)], prompt_variant=prompt_variant
+    )
+    result = await chain.acall(
+        {"input_documents": sources, "question": query}, return_only_outputs=True
+    )
+    trace.emit(cache_hit=False)
+
+    return result["output_text"]
+
+
+@stub.local_entrypoint()
+def batch_cli(questions: str, output: str = None, prompt_variant: str = None):
+    """Answers a file of questions with qanda_batch, writing the results as JSONL.
+
+    Questions are read from a JSON list of strings, or JSONL records with a
+    "question" field. By default, results are written next to the questions.
+    """
+    import json
+    from pathlib import Path
+
+    with open(questions) as f:
+        contents = f.read()
+    if contents.lstrip().startswith("["):
+        queries = json.loads(contents)
+    else:
+        queries = [
+            json.loads(line)["question"] for line in contents.splitlines() if line
+        ]
+
+    output = output or Path(questions).with_suffix(".answers.jsonl")
+    pretty_log(f"answering {len(queries)} questions from {questions}")
+    records = qanda_batch.remote(queries, prompt_variant=prompt_variant)
+
+    with open(output, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    pretty_log(f"wrote {len(records)} answers to {output}")
+
+
 web_app = FastAPI(docs_url=None)
 
 
@@ -257,12 +828,27 @@ async def redirect_docs():
     return "/gradio/docs"
 
 
+@web_app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Exposes this container's stage latencies, token counts and cache stats.
+
+    Metrics are kept in each container's memory, so these only cover questions
+    answered in the fastapi_app container, i.e. from the Gradio UI. Questions sent
+    to web, qanda or qanda_batch run in containers of their own, whose metrics
+    are not exported here. Their per-request traces are in the logs.
+    """
+    import monitoring
+
+    return monitoring.render_metrics()
+
+
 @stub.function(
     image=image,
     network_file_systems={
         str(VECTOR_DIR): vector_storage,
     },
     keep_warm=1,
+    allow_concurrent_inputs=MAX_CONCURRENT_QUESTIONS,
 )
 @modal.asgi_app(label="askfsdl-backend")
 def fastapi_app():
@@ -270,8 +856,13 @@ def fastapi_app():
     import gradio as gr
     from gradio.routes import App
 
-    def chain_with_logging(*args, **kwargs):
-        return qanda(*args, with_logging=True, **kwargs)
+    import prompts
+
+    async def chain_with_logging(query):
+        answer = ""
+        async for token in stream_qanda(query, with_logging=True):
+            answer += token
+            yield answer
 
     inputs = gr.TextArea(
         label="Question",
@@ -288,20 +879,14 @@ def fastapi_app():
         outputs=outputs,
         title="Ask Questions About The Full Stack.",
         description="Get answers with sources from an LLM.",
-        examples=[
-            "What is zero-shot chain-of-thought prompting?",
-            "Would you rather fight 100 LLaMA-sized GPT-4s or 1 GPT-4-sized LLaMA?",
-            "What are the differences in capabilities between GPT-3 davinci and GPT-3.5 code-davinci-002?",  # noqa: E501
-            "What is PyTorch? How can I decide whether to choose it over TensorFlow?",
-            "Is it cheaper to run experiments on cheap GPUs or expensive GPUs?",
-            "How do I recruit an ML team?",
-            "What is the best way to learn about ML?",
-        ],
+        examples=prompts.EXAMPLE_QUESTIONS,
         allow_flagging="never",
         theme=gr.themes.Default(radius_size="none", text_size="lg"),
         article="# GitHub Repo: https://github.com/the-full-stack/ask-fsdl",
     )
 
+    # needed to stream answers into the UI as they arrive, many questions at a time
+    interface.queue(concurrency_count=MAX_CONCURRENT_QUESTIONS)
     interface.dev_mode = False
     interface.config = interface.get_config_file()
     interface.validate_queue_settings()
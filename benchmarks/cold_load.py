@@ -0,0 +1,125 @@
+"""Compares cold load times and memory of memory-mapped and pickled vector indexes.
+
+Runs offline, on a frozen corpus snapshot, like benchmarks.retrieval:
+
+python -m benchmarks.cold_load --corpus frozen.jsonl --model hashing-ngram-1024
+
+The corpus is indexed once and saved in both formats: as FAISS.save_local writes
+it, with a pickled docstore, and as vecstore.save_vector_index writes it, with a
+chunkstore. Each load runs in a fresh process, as in a new container, and reports
+the time to load, the time of a first search that reads the top-k chunks, and the
+memory the load and search add to the process, on Linux. Files stay in the OS
+page cache between runs, so the disk reads of a truly cold container are not
+included. Chunkstore loads also load the BM25 and filter indexes, which the
+pickled format lacks.
+"""
+import argparse
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+import vecstore
+from benchmarks.retrieval import (
+    OfflineEmbeddings,
+    embed_everything,
+    get_offline_engine,
+    load_corpus,
+)
+from utils import pretty_log
+
+INDEX_NAME = "benchmark-cold-load"
+
+
+def main(corpus, model, cache_dir=None, index_type="flat", k=10, repeats=5):
+    chunks = load_corpus(corpus)
+    pretty_log(f"indexing {len(chunks)} chunks as {index_type}")
+
+    engine = get_offline_engine(model, cache_dir)
+    engine, (query,) = embed_everything(engine, chunks, ["What is a transformer?"])
+    vector_index = vecstore.create_vector_index(
+        INDEX_NAME, engine, chunks, index_type=index_type
+    )
+
+    with tempfile.TemporaryDirectory() as folder:
+        pickled = Path(folder) / "pickled"
+        vector_index.save_local(str(pickled), INDEX_NAME)
+        vecstore.VECTOR_DIR = Path(folder)
+        vecstore.VERSIONS_DIR = Path(folder) / "versions"
+        vecstore.EMBEDDING_CACHE_DIR = Path(folder) / "embedding-cache"
+        version = vecstore.save_vector_index(vector_index, INDEX_NAME)
+        mapped = vecstore.get_index_dir(INDEX_NAME, version)
+        pretty_log(
+            f"pickled index takes {_size(pickled) / 2**20:.1f} MiB,"
+            f" mapped index takes {_size(mapped) / 2**20:.1f} MiB"
+        )
+
+        print("\t".join(["format", "load_ms", "first_search_ms", "added_rss_mib"]))
+        context = multiprocessing.get_context("spawn")
+        for name, folder_path, mmap in [
+            ("pickle", pickled, False),
+            ("chunkstore", mapped, False),
+            ("chunkstore-mmap", mapped, True),
+        ]:
+            runs = []
+            for _ in range(repeats):
+                with context.Pool(1) as pool:
+                    args = (name, folder_path, vector_index.manifest, query, k, mmap)
+                    runs.append(pool.apply(cold_load, args))
+            row = [name] + [sorted(column)[len(column) // 2] for column in zip(*runs)]
+            print("\t".join(f"{v:.1f}" if isinstance(v, float) else v for v in row))
+
+
+def cold_load(name, folder_path, manifest, query, k, mmap):
+    """Loads an index in this process and searches it once, timing both."""
+    from langchain.vectorstores import FAISS
+
+    engine = OfflineEmbeddings(manifest["embedding_model"])  # queries are embedded
+    rss = _rss()
+    start = time.perf_counter()
+    if name == "pickle":
+        vector_index = FAISS.load_local(str(folder_path), engine, INDEX_NAME)
+        vector_index.manifest = manifest
+        vecstore._apply_search_defaults(vector_index)
+    else:
+        vecstore.VERSIONS_DIR = folder_path.parents[1]
+        vector_index = vecstore.connect_to_vector_index(
+            INDEX_NAME, engine, version=folder_path.name, mmap=mmap
+        )
+    loaded = time.perf_counter()
+    vecstore.search(vector_index, query, k=k)
+    searched = time.perf_counter()
+
+    return 1000 * (loaded - start), 1000 * (searched - loaded), _rss() - rss
+
+
+def _rss():
+    """Reads the resident memory of this process, in MiB."""
+    import os
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _size(folder):
+    return sum(file.stat().st_size for file in Path(folder).iterdir())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", required=True, help="JSONL corpus snapshot")
+    parser.add_argument("--model", default=vecstore.get_embedding_model())
+    parser.add_argument("--cache-dir", default=None, help="local embedding cache")
+    parser.add_argument("--index-type", default="flat", choices=vecstore.INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    main(
+        args.corpus,
+        args.model,
+        cache_dir=args.cache_dir,
+        index_type=args.index_type,
+        k=args.k,
+        repeats=args.repeats,
+    )
@@ -0,0 +1,78 @@
+"""Compares the throughput of ways of reading documents from the document store.
+
+Reads from a live MongoDB, so MONGODB_HOST, MONGODB_USER and MONGODB_PASSWORD
+must be set, e.g. from .env:
+
+python -m benchmarks.docstore_reads --db fsdl --collection ask-fsdl
+
+Each strategy reads every document that index builds read, once per repeat, and
+reports the median documents per second, relative to the plain find cursor that
+docstore.get_documents returns.
+"""
+import argparse
+import time
+
+import docstore
+from utils import pretty_log
+
+
+def main(collection=None, db=None, batch_sizes=(100, 1000), workers=(4,), repeats=3):
+    strategies = [("cursor", lambda: docstore.get_documents(collection, db))]
+    for batch_size in batch_sizes:
+        strategies += [
+            (
+                f"projected-{batch_size}",
+                lambda b=batch_size: docstore.stream_documents(
+                    collection, db, batch_size=b
+                ),
+            ),
+            (
+                f"tuples-{batch_size}",
+                lambda b=batch_size: docstore.stream_documents(
+                    collection, db, batch_size=b, as_tuples=True
+                ),
+            ),
+        ]
+        for n_workers in workers:
+            strategies.append(
+                (
+                    f"parallel-{n_workers}-{batch_size}",
+                    lambda b=batch_size, w=n_workers: docstore.stream_documents(
+                        collection, db, batch_size=b, workers=w, as_tuples=True
+                    ),
+                )
+            )
+
+    pretty_log(f"reading with {len(strategies)} strategies, {repeats} times each")
+    print("\t".join(["strategy", "documents", "seconds", "docs_per_s", "speedup"]))
+    baseline = None
+    for name, read in strategies:
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            count = sum(1 for _ in read())
+            runs.append((time.perf_counter() - start, count))
+        seconds, count = sorted(runs)[len(runs) // 2]
+
+        rate = count / seconds
+        baseline = baseline or rate
+        row = [name, count, seconds, rate, rate / baseline]
+        print("\t".join(f"{v:.2f}" if isinstance(v, float) else str(v) for v in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--collection", default=None)
+    parser.add_argument("--db", default=None)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[4])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    main(
+        args.collection,
+        args.db,
+        batch_sizes=args.batch_sizes,
+        workers=args.workers,
+        repeats=args.repeats,
+    )
@@ -0,0 +1,190 @@
+"""Exercises the async embedding scheduler against a local fake embedding server.
+
+Runs locally, without Modal or any API keys:
+
+python -m benchmarks.embedding --n-texts 5000 --tokens-per-minute 600000
+
+The fake server mimics the OpenAI embeddings endpoint: it adds latency to each
+request, fails some requests at random, drops the connection of others, and
+enforces a token-per-minute quota with 429 responses and rate-limit headers.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+
+import embedder
+from utils import pretty_log
+
+
+class FakeEmbeddingServer:
+    """A local stand-in for the OpenAI embeddings endpoint."""
+
+    def __init__(
+        self,
+        tokens_per_minute=600_000,
+        latency=0.2,
+        failure_rate=0.02,
+        disconnect_rate=0.02,
+        dimension=1536,
+        port=8765,
+    ):
+        self.tokens_per_minute = tokens_per_minute
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.disconnect_rate = disconnect_rate
+        self.dimension = dimension
+        self.port = port
+        self.stats = {"requests": 0, "rate_limited": 0, "failed": 0, "dropped": 0}
+
+        self._window_start, self._window_tokens = time.monotonic(), 0
+        self._runner = None
+
+    @property
+    def api_base(self):
+        return f"http://localhost:{self.port}/v1"
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/v1/embeddings", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "localhost", self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        self.stats["requests"] += 1
+        body = await request.json()
+        texts = body["input"]
+        tokens = sum(count_tokens(text) for text in texts)
+
+        now = time.monotonic()
+        if now - self._window_start >= 60:
+            self._window_start, self._window_tokens = now, 0
+        remaining = self.tokens_per_minute - self._window_tokens
+        reset = 60 - (now - self._window_start)
+        headers = {
+            "x-ratelimit-remaining-tokens": str(max(0, remaining - tokens)),
+            "x-ratelimit-reset-tokens": f"{reset:.3f}s",
+        }
+
+        if tokens > remaining:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached"}},
+                status=429,
+                headers=headers,
+            )
+
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.stats["failed"] += 1
+            return web.json_response({"error": {"message": "oops"}}, status=503)
+        if random.random() < self.disconnect_rate:  # like a stale keep-alive
+            self.stats["dropped"] += 1
+            request.transport.close()
+            return web.Response()
+
+        self._window_tokens += tokens
+        data = [
+            {"index": ii, "embedding": fake_embedding(text, self.dimension)}
+            for ii, text in enumerate(texts)
+        ]
+        return web.json_response({"data": data}, headers=headers)
+
+
+def fake_embedding(text, dimension):
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    return [rng.gauss(0, 1) for _ in range(dimension)]
+
+
+def count_tokens(text):
+    """Approximates token counts, so the server needs no tokenizer files."""
+    return max(1, len(text) // 4)
+
+
+async def run(
+    n_texts,
+    tokens_per_minute,
+    concurrencies,
+    dimension,
+    client_tokens_per_minute,
+    disconnect_rate=0.02,
+):
+    server = FakeEmbeddingServer(
+        tokens_per_minute=tokens_per_minute,
+        disconnect_rate=disconnect_rate,
+        dimension=dimension,
+    )
+    await server.start()
+    texts = [
+        f"chunk {ii}: " + "lorem ipsum dolor sit amet " * 60 for ii in range(n_texts)
+    ]
+
+    try:
+        for concurrency in concurrencies:
+            engine = embedder.AsyncEmbedder(
+                api_base=server.api_base,
+                api_key="fake",
+                max_concurrency=concurrency,
+                tokens_per_minute=client_tokens_per_minute,
+                count_tokens=count_tokens,
+            )
+            start = time.monotonic()
+            try:
+                embeddings = await engine.aembed_documents(texts)
+                elapsed = time.monotonic() - start
+            finally:
+                await engine.aclose()
+
+            assert len(embeddings) == len(texts)
+            assert embeddings[7] == fake_embedding(texts[7], dimension), "out of order"
+            assert engine.stats["retries"] > 0 or not server.stats["dropped"]
+            pretty_log(
+                f"concurrency {concurrency}: {n_texts / elapsed:.0f} texts/s, "
+                f"{engine.stats}, final limit {engine.limiter.limit}"
+            )
+    finally:
+        await server.stop()
+
+    pretty_log(f"server saw {server.stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--n-texts", type=int, default=5000)
+    parser.add_argument("--tokens-per-minute", type=int, default=600_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument(
+        "--client-tokens-per-minute",
+        type=int,
+        default=None,
+        help="the scheduler's token budget, set above the server's to force 429s",
+    )
+    parser.add_argument(
+        "--disconnect-rate",
+        type=float,
+        default=0.02,
+        help="the share of requests whose connection the server drops",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        run(
+            args.n_texts,
+            args.tokens_per_minute,
+            args.concurrency,
+            args.dimension,
+            args.client_tokens_per_minute or args.tokens_per_minute,
+            disconnect_rate=args.disconnect_rate,
+        )
+    )
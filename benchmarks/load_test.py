@@ -0,0 +1,117 @@
+"""Load tests the Q&A web endpoint, sweeping over the number of concurrent clients.
+
+Point it at a deployed or served web endpoint:
+
+modal serve app.py
+python -m benchmarks.load_test --url https://<your-workspace>--askfsdl-backend-web-dev.modal.run
+
+Each client sends questions back to back, so throughput should grow with the
+number of clients until a container's allow_concurrent_inputs is reached, rather
+than staying flat at one question per worker. Questions default to the Gradio
+examples, each made unique per request so that the answer cache doesn't serve them.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+import uuid
+
+from utils import pretty_log
+
+
+async def run_level(url, questions, concurrency, requests_per_client, stream=False):
+    """Runs one level of the sweep and summarizes its latencies and throughput."""
+    import aiohttp
+    import numpy as np
+
+    questions = itertools.cycle(questions)
+    latencies, first_tokens, failures = [], [], 0
+
+    async def client(session):
+        nonlocal failures
+        for _ in range(requests_per_client):
+            request_id = uuid.uuid4().hex
+            params = {"query": f"{next(questions)} ({request_id[:8]})"}
+            params.update({"request_id": request_id, "stream": str(stream).lower()})
+            start = time.perf_counter()
+            try:
+                async with session.get(url, params=params) as response:
+                    if response.status != 200:
+                        failures += 1
+                        continue
+                    if stream:
+                        await response.content.readline()
+                        first_tokens.append(time.perf_counter() - start)
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    timeout = aiohttp.ClientTimeout(total=300)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies or [float("nan")])
+    result = {
+        "concurrency": concurrency,
+        "completed": int(np.isfinite(latencies).sum()),
+        "failed": failures,
+        "qps": float(np.isfinite(latencies).sum() / elapsed),
+        "p50_s": float(np.percentile(latencies, 50)),
+        "p95_s": float(np.percentile(latencies, 95)),
+    }
+    if stream:
+        result["ttft_p50_s"] = float(np.percentile(first_tokens or [float("nan")], 50))
+
+    return result
+
+
+async def main(url, questions, levels, requests_per_client, stream=False):
+    results = []
+    for concurrency in levels:
+        pretty_log(f"running {concurrency} concurrent clients")
+        results.append(
+            await run_level(url, questions, concurrency, requests_per_client, stream)
+        )
+
+    columns = list(results[0])
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(_format(result[column]) for column in columns))
+
+    baseline = results[0]["qps"]
+    for result in results[1:]:
+        pretty_log(
+            f"{result['concurrency']} clients: {result['qps'] / baseline:.1f}x"
+            f" the throughput of {results[0]['concurrency']}"
+        )
+
+
+def _format(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", required=True, help="URL of the web endpoint")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--queries", default=None, help="JSON or JSONL questions")
+    parser.add_argument("--stream", action="store_true", help="request SSE answers")
+    args = parser.parse_args()
+
+    from benchmarks.retrieval import load_queries
+
+    asyncio.run(
+        main(
+            args.url,
+            load_queries(args.queries),
+            args.concurrency,
+            args.requests_per_client,
+            stream=args.stream,
+        )
+    )
@@ -0,0 +1,108 @@
+"""Compares fixed top-k context stuffing against token-budgeted context packing.
+
+Runs offline, on a frozen corpus snapshot, like benchmarks.retrieval:
+
+python -m benchmarks.packing --corpus frozen.jsonl --model hashing-ngram-1024
+
+For each strategy, reports the tokens of context put in the prompt, the number of
+chunks and distinct sources, and how many of the exact top-k chunks are kept.
+Packed chunks that were trimmed of overlapping text still count as kept.
+"""
+import argparse
+
+import packing
+import vecstore
+from benchmarks.retrieval import (
+    embed_everything,
+    get_offline_engine,
+    load_corpus,
+    load_queries,
+)
+from utils import count_tokens, pretty_log
+
+
+def main(corpus, model, queries=None, cache_dir=None, k=3, budgets=(500, 1000, 1500)):
+    import numpy as np
+
+    chunks = load_corpus(corpus)
+    questions = load_queries(queries)
+    pretty_log(
+        f"packing context for {len(questions)} queries over {len(chunks)} chunks"
+    )
+
+    engine = get_offline_engine(model, cache_dir)
+    engine, query_embeddings = embed_everything(engine, chunks, questions)
+    vector_index = vecstore.create_vector_index("benchmark-packing", engine, chunks)
+
+    candidates = [
+        vecstore.search(vector_index, embedding, k=packing.CONFIG["CANDIDATES"])
+        for embedding in query_embeddings
+    ]
+    exact = [[document for document, _ in hits[:k]] for hits in candidates]
+
+    strategies = [(f"top-{k}", lambda hits: (_stuff(hits[:k]), None))]
+    for budget in budgets:
+        strategies.append(
+            (f"packed-{budget}", lambda hits, b=budget: packing.pack(hits, budget=b))
+        )
+
+    columns = ["strategy", "tokens_mean", "tokens_p95", "chunks", "sources"]
+    columns.append(f"kept@{k}")
+    print("\t".join(columns))
+    for name, strategy in strategies:
+        tokens, n_chunks, n_sources, kept = [], [], [], []
+        for hits, expected in zip(candidates, exact):
+            documents, used = strategy(hits)
+            if used is None:
+                used = _count(documents)
+            tokens.append(used)
+            n_chunks.append(len(documents))
+            n_sources.append(len({doc.metadata.get("source") for doc in documents}))
+            ids = {doc.metadata["_chunk_id"] for doc in documents}
+            found = sum(doc.metadata["_chunk_id"] in ids for doc in expected)
+            kept.append(found / max(1, len(expected)))
+
+        row = [
+            name,
+            np.mean(tokens),
+            np.percentile(tokens, 95),
+            np.mean(n_chunks),
+            np.mean(n_sources),
+            np.mean(kept),
+        ]
+        print("\t".join(f"{v:.2f}" if isinstance(v, float) else str(v) for v in row))
+
+
+def _stuff(hits):
+    return [document for document, _ in hits]
+
+
+def _count(documents):
+    return sum(
+        count_tokens(
+            packing.DOCUMENT_TEMPLATE.format(
+                page_content=doc.page_content, source=doc.metadata.get("source")
+            )
+        )
+        for doc in documents
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", required=True, help="JSONL corpus snapshot")
+    parser.add_argument("--model", default=vecstore.get_embedding_model())
+    parser.add_argument("--queries", default=None, help="JSON or JSONL questions")
+    parser.add_argument("--cache-dir", default=None, help="local embedding cache")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--budgets", type=int, nargs="+", default=[500, 1000, 1500])
+    args = parser.parse_args()
+
+    main(
+        args.corpus,
+        args.model,
+        queries=args.queries,
+        cache_dir=args.cache_dir,
+        k=args.k,
+        budgets=args.budgets,
+    )
@@ -0,0 +1,66 @@
+"""Reports the token overhead of each prompt variant and the cost of counting it.
+
+Runs locally, without Modal or any API keys:
+
+python -m benchmarks.prompt_tokens
+
+For each variant in prompts.VARIANTS, reports the tokens in its static prefix and
+the tokens in a full prompt for each example question, without any sources, so
+the overhead per request can be compared. Also times formatting and counting the
+tokens of a prompt, with and without the cached count of the prefix.
+"""
+import argparse
+import time
+
+import prompts
+from utils import count_tokens
+
+
+def main(questions, repeats=200):
+    columns = ["variant", "prefix_tokens", "prompt_tokens", "format_us"]
+    columns += ["count_us", "cached_count_us"]
+    print("\t".join(columns))
+
+    baseline = None
+    for name, prompt in prompts.VARIANTS.items():
+        texts = [prompt.format(question=q, sources="") for q in questions]
+        prompt_tokens = sum(map(count_tokens, texts)) / len(texts)
+
+        format_us = _time(
+            lambda p=prompt: [p.format(question=q, sources="") for q in questions],
+            repeats,
+            len(questions),
+        )
+        count_us = _time(
+            lambda ts=texts: [count_tokens(t) for t in ts], repeats, len(texts)
+        )
+        cached_us = _time(
+            lambda p=prompt, ts=texts: [p.count_tokens(t) for t in ts],
+            repeats,
+            len(texts),
+        )
+
+        row = [name, prompts.count_prefix_tokens(prompt.prefix), prompt_tokens]
+        row += [format_us, count_us, cached_us]
+        print("\t".join(f"{v:.1f}" if isinstance(v, float) else str(v) for v in row))
+
+        baseline = baseline or prompt_tokens
+        if prompt_tokens != baseline:
+            saved = baseline - prompt_tokens
+            print(f"# {name} saves {saved:.0f} prompt tokens per request")
+
+
+def _time(run, repeats, n):
+    """Times a run over n items, returning microseconds per item."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run()
+    return 1e6 * (time.perf_counter() - start) / (repeats * n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    main(prompts.EXAMPLE_QUESTIONS, repeats=args.repeats)
@@ -0,0 +1,99 @@
+"""Compares retrieval quality and latency with and without reranking.
+
+Runs offline, on a frozen corpus snapshot, like benchmarks.retrieval:
+
+python -m benchmarks.reranking --corpus frozen.jsonl --model hashing-ngram-1024
+
+Quality is measured on known-item queries: a run of words is taken from a random
+chunk, and the rank of that chunk in the results is recorded. Reports hit@1,
+hit@3 and the mean reciprocal rank within the top 10, along with the latency of
+the reranking stage alone. Pass --rerank-model to also try a cross-encoder.
+"""
+import argparse
+import random
+import time
+
+import packing
+import reranking
+import vecstore
+from benchmarks.retrieval import embed_everything, get_offline_engine, load_corpus
+from utils import pretty_log
+
+
+def main(corpus, model, cache_dir=None, n_queries=200, rerank_models=(), seed=0):
+    import numpy as np
+
+    chunks = load_corpus(corpus)
+    queries, targets = known_item_queries(chunks, n_queries, seed)
+    pretty_log(f"reranking for {len(queries)} queries over {len(chunks)} chunks")
+
+    engine = get_offline_engine(model, cache_dir)
+    engine, query_embeddings = embed_everything(engine, chunks, queries)
+    vector_index = vecstore.create_vector_index("benchmark-reranking", engine, chunks)
+    vector_index.sparse_index = vecstore.build_sparse_index(vector_index)
+
+    def search(k):
+        return vecstore.hybrid_search_batch(
+            vector_index, query_embeddings, queries, k=k
+        )
+
+    baseline = search(packing.CONFIG["CANDIDATES"])
+    candidates = search(reranking.CONFIG["CANDIDATES"])
+
+    print("\t".join(["reranker", "hit@1", "hit@3", "mrr@10", "p50_ms", "p95_ms"]))
+    configurations = [("none", None)] + [(m, m) for m in ("hybrid", *rerank_models)]
+    for name, rerank_model in configurations:
+        ranks, latencies = [], []
+        for query, target, hits, pool in zip(queries, targets, baseline, candidates):
+            if rerank_model is not None:
+                start = time.perf_counter()
+                hits = reranking.rerank(
+                    query,
+                    pool,
+                    vector_index.sparse_index,
+                    top_n=10,
+                    model=rerank_model,
+                )
+                latencies.append(1000 * (time.perf_counter() - start))
+            ids = [doc.metadata["_chunk_id"] for doc, _ in hits[:10]]
+            ranks.append(ids.index(target) + 1 if target in ids else None)
+
+        row = [
+            name,
+            np.mean([rank == 1 for rank in ranks]),
+            np.mean([rank is not None and rank <= 3 for rank in ranks]),
+            np.mean([1 / rank if rank else 0.0 for rank in ranks]),
+            np.percentile(latencies, 50) if latencies else 0.0,
+            np.percentile(latencies, 95) if latencies else 0.0,
+        ]
+        print("\t".join(f"{v:.3f}" if isinstance(v, float) else str(v) for v in row))
+
+
+def known_item_queries(chunks, n_queries, seed=0, words=12):
+    """Makes queries from runs of words in random chunks, with the chunks' ids."""
+    rng = random.Random(seed)
+    queries, targets = [], []
+    for chunk_id, text, _ in rng.sample(chunks, min(n_queries, len(chunks))):
+        tokens = text.split()
+        start = rng.randrange(max(1, len(tokens) - words))
+        queries.append(" ".join(tokens[start : start + words]))
+        targets.append(chunk_id)
+    return queries, targets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", required=True, help="JSONL corpus snapshot")
+    parser.add_argument("--model", default=vecstore.get_embedding_model())
+    parser.add_argument("--cache-dir", default=None, help="local embedding cache")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--rerank-model", nargs="*", default=[])
+    args = parser.parse_args()
+
+    main(
+        args.corpus,
+        args.model,
+        cache_dir=args.cache_dir,
+        n_queries=args.queries,
+        rerank_models=args.rerank_model,
+    )
@@ -0,0 +1,253 @@
+"""Benchmarks retrieval latency, throughput, memory and recall across index types.
+
+Runs fully offline, without Modal or any API keys, on a frozen corpus snapshot:
+
+modal run app.py::stub.snapshot_corpus --name frozen
+modal nfs get vector-vol snapshots/frozen.jsonl .
+python -m benchmarks.retrieval --corpus frozen.jsonl --model hashing-ngram-1024
+
+Queries default to the Gradio examples. Pass --queries with a JSON list or a JSONL
+file of {"question": ...} records, e.g. logged questions, to use more.
+
+OpenAI models are run from the embedding cache only: copy the cache over with
+`modal nfs get vector-vol embedding-cache .` and pass --cache-dir. Every text
+must already be cached, since the benchmark never calls the API.
+
+Recall@k is measured against exact, flat search with the same embeddings. With
+--compare-model, the overlap between the exact top-k of two models is reported.
+"""
+import argparse
+import json
+import time
+
+import vecstore
+from utils import pretty_log
+
+# (index type, build parameters, search parameters) for each configuration
+CONFIGURATIONS = (
+    [("flat", {}, {})]
+    + [("ivf-flat", {}, {"nprobe": nprobe}) for nprobe in (1, 4, 16, 64)]
+    + [("ivf-pq", {}, {"nprobe": nprobe}) for nprobe in (4, 16, 64)]
+    + [("hnsw", {}, {"ef_search": ef_search}) for ef_search in (16, 64, 256)]
+)
+
+
+def main(
+    corpus,
+    model,
+    queries=None,
+    cache_dir=None,
+    ks=(3, 10),
+    repeats=5,
+    compare_model=None,
+    output=None,
+):
+    chunks = load_corpus(corpus)
+    questions = load_queries(queries)
+    pretty_log(f"benchmarking {len(questions)} queries over {len(chunks)} chunks")
+
+    engine = get_offline_engine(model, cache_dir)
+    engine, query_embeddings = embed_everything(engine, chunks, questions)
+
+    results, exact, built, build_times = [], {}, {}, {}
+    for index_type, build_params, search_params in CONFIGURATIONS:
+        key = (index_type, json.dumps(build_params, sort_keys=True))
+        if key not in built:
+            start = time.monotonic()
+            built[key] = vecstore.create_vector_index(
+                f"benchmark-{index_type}",
+                engine,
+                chunks,
+                index_type=index_type,
+                index_params=build_params,
+            )
+            build_times[key] = time.monotonic() - start
+        vector_index = built[key]
+
+        result = run_configuration(
+            vector_index, query_embeddings, max(ks), repeats, **search_params
+        )
+        if index_type == "flat":
+            exact = result.pop("top_ids")
+        result.update(
+            {
+                "index_type": index_type,
+                "params": dict(vector_index.manifest["params"], **search_params),
+                "build_s": build_times[key],
+                "index_bytes": index_size(vector_index),
+            }
+        )
+        top_ids = result.pop("top_ids", exact)
+        for k in ks:
+            result[f"recall@{k}"] = recall_at_k(top_ids, exact, k)
+        results.append(result)
+
+    report(results, ks)
+
+    if compare_model:
+        other = get_offline_engine(compare_model, cache_dir)
+        other, other_embeddings = embed_everything(other, chunks, questions)
+        other_index = vecstore.create_vector_index("benchmark-compare", other, chunks)
+        other_exact = run_configuration(other_index, other_embeddings, max(ks), 1)
+        for k in ks:
+            overlap = recall_at_k(exact, other_exact["top_ids"], k)
+            pretty_log(
+                f"overlap@{k} between {model} and {compare_model}: {overlap:.3f}"
+            )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def run_configuration(vector_index, query_embeddings, k, repeats, **search_params):
+    """Times single-query searches and collects the top-k chunk ids per query."""
+    import numpy as np
+
+    latencies, top_ids = [], []
+    for _ in range(repeats):
+        top_ids = []
+        for embedding in query_embeddings:
+            start = time.perf_counter()
+            hits = vecstore.search(vector_index, embedding, k=k, **search_params)
+            latencies.append(time.perf_counter() - start)
+            top_ids.append([document.metadata["_chunk_id"] for document, _ in hits])
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "qps": float(1000 * len(latencies) / latencies.sum()),
+        "top_ids": top_ids,
+    }
+
+
+def recall_at_k(top_ids, exact_ids, k):
+    """Averages, over queries, the fraction of the exact top-k that was found."""
+    recalls = [
+        len(set(found[:k]) & set(expected[:k])) / max(1, len(expected[:k]))
+        for found, expected in zip(top_ids, exact_ids)
+    ]
+    return sum(recalls) / max(1, len(recalls))
+
+
+def index_size(vector_index):
+    """Measures the memory footprint of the FAISS index by serializing it."""
+    import faiss
+
+    return int(faiss.serialize_index(vector_index.index).nbytes)
+
+
+def report(results, ks):
+    columns = ["index_type", "params", "p50_ms", "p95_ms", "p99_ms", "qps"]
+    columns += ["index_bytes", "build_s"] + [f"recall@{k}" for k in ks]
+    print("\t".join(columns))
+    for result in results:
+        print("\t".join(_format(result[column]) for column in columns))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    if isinstance(value, dict):
+        return ",".join(f"{k}={v}" for k, v in value.items()) or "-"
+    return str(value)
+
+
+def embed_everything(engine, chunks, questions):
+    """Embeds the corpus and queries once, so that index builds reuse them."""
+    texts = [text for _, text, _ in chunks]
+    embeddings = engine.embed_documents(texts)
+    query_embeddings = engine.embed_documents(questions)
+
+    return PrecomputedEmbeddings(engine, texts, embeddings), query_embeddings
+
+
+class PrecomputedEmbeddings:
+    """Serves embeddings computed ahead of time, falling back to an engine."""
+
+    def __init__(self, engine, texts, embeddings):
+        self.engine = engine
+        self.model = getattr(engine, "model", None)
+        self.embeddings = dict(zip(texts, embeddings))
+
+    def embed_documents(self, texts):
+        missing = [text for text in texts if text not in self.embeddings]
+        if missing:
+            self.embeddings.update(zip(missing, self.engine.embed_documents(missing)))
+        return [self.embeddings[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class OfflineEmbeddings:
+    """Stands in for an API-backed engine, failing on any text not in the cache."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def embed_documents(self, texts):
+        raise KeyError(
+            f"{len(texts)} texts are not in the {self.model} embedding cache"
+        )
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def get_offline_engine(model, cache_dir=None):
+    if model.startswith("hashing-"):
+        return vecstore.get_embedding_engine(model)
+    return vecstore.CachedEmbeddings(OfflineEmbeddings(model), model, cache_dir)
+
+
+def load_corpus(path):
+    """Loads a snapshot written by app.snapshot_corpus as (id, text, metadata)."""
+    chunks = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                metadata = dict(record["metadata"], _chunk_id=record["id"])
+                chunks.append((record["id"], record["text"], metadata))
+    return chunks
+
+
+def load_queries(path=None):
+    """Loads questions from a JSON list or JSONL records, or the Gradio examples."""
+    if path is None:
+        import prompts
+
+        return list(prompts.EXAMPLE_QUESTIONS)
+
+    with open(path) as f:
+        contents = f.read()
+    if contents.lstrip().startswith("["):
+        return json.loads(contents)
+    return [json.loads(line)["question"] for line in contents.splitlines() if line]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", required=True, help="JSONL corpus snapshot")
+    parser.add_argument("--model", default=vecstore.get_embedding_model())
+    parser.add_argument("--queries", default=None, help="JSON or JSONL questions")
+    parser.add_argument("--cache-dir", default=None, help="local embedding cache")
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--compare-model", default=None)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    main(
+        args.corpus,
+        args.model,
+        queries=args.queries,
+        cache_dir=args.cache_dir,
+        ks=args.k,
+        repeats=args.repeats,
+        compare_model=args.compare_model,
+        output=args.output,
+    )
@@ -0,0 +1,75 @@
+"""Benchmarks serial versus parallel splitting of documents into chunks.
+
+Runs locally, without Modal or any API keys:
+
+python -m benchmarks.splitting --processes 8 --corpus /path/to/documents.jsonl
+
+The corpus is a JSONL file with one {"text": ..., "metadata": ...} document per
+line. Without one, a synthetic corpus is generated.
+"""
+import argparse
+import json
+import time
+
+import vecstore
+from utils import pretty_log
+
+
+def main(corpus=None, processes=8, n_documents=2000):
+    documents = load_corpus(corpus) if corpus else synthetic_corpus(n_documents)
+    pretty_log(f"splitting {len(documents)} documents")
+
+    serial_time, serial_chunks = time_split(documents, processes=1)
+    pretty_log(f"serial: {len(serial_chunks)} chunks in {serial_time:.2f}s")
+
+    parallel_time, parallel_chunks = time_split(documents, processes=processes)
+    pretty_log(
+        f"{processes} processes: {len(parallel_chunks)} chunks in {parallel_time:.2f}s"
+    )
+
+    assert parallel_chunks == serial_chunks, "parallel split does not match serial"
+    pretty_log(f"speedup: {serial_time / parallel_time:.2f}x")
+
+
+def time_split(documents, processes):
+    start = time.monotonic()
+    chunks = list(vecstore.split_documents(documents, processes=processes))
+    return time.monotonic() - start, chunks
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_corpus(n_documents, words_per_document=1500, seed=0):
+    """Generates documents of random words with unique hashes."""
+    import hashlib
+    import random
+
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 10)))
+        for _ in range(5000)
+    ]
+
+    documents = []
+    for _ in range(n_documents):
+        words = rng.choices(vocabulary, k=words_per_document)
+        text = "\n\n".join(
+            " ".join(words[ii : ii + 100]) for ii in range(0, len(words), 100)
+        )
+        sha256 = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        documents.append({"text": text, "metadata": {"sha256": sha256}})
+
+    return documents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corpus", default=None, help="path to a JSONL corpus")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--n-documents", type=int, default=2000)
+    args = parser.parse_args()
+
+    main(args.corpus, args.processes, args.n_documents)
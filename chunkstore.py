@@ -0,0 +1,139 @@
+"""A memory-mapped store of the texts and metadata of the chunks in a vector index."""
+import json
+from collections.abc import Mapping
+from pathlib import Path
+
+
+def write(path, chunks):
+    """Writes (FAISS id, docstore id, Document) chunks to a chunk store.
+
+    Chunks are written as JSON lines to path.jsonl, and their FAISS ids and byte
+    offsets, sorted by id, to path.npy, so any one chunk can be read on its own.
+    """
+    import numpy as np
+
+    rows, offset = [], 0
+    with open(_with_suffix(path, ".jsonl"), "wb") as f:
+        for faiss_id, docstore_id, document in chunks:
+            record = {
+                "id": docstore_id,
+                "page_content": document.page_content,
+                "metadata": document.metadata,
+            }
+            line = json.dumps(record, default=str).encode("utf-8")
+            f.write(line + b"\n")
+            rows.append((faiss_id, offset, offset + len(line)))
+            offset += len(line) + 1
+
+    table = np.array(rows, dtype="int64").reshape(-1, 3)
+    table = table[np.argsort(table[:, 0])]
+    np.save(_with_suffix(path, ".npy"), np.ascontiguousarray(table.T))
+
+    return len(rows)
+
+
+def exists(path):
+    """Checks whether a chunk store has been written at path."""
+    return _with_suffix(path, ".jsonl").exists() and _with_suffix(path, ".npy").exists()
+
+
+class ChunkStore:
+    """Reads chunks from a store written by write, without loading it into memory.
+
+    Both files are memory-mapped, so opening a store only reads its headers, and
+    looking up a chunk reads just the pages that hold it. The operating system's
+    page cache is shared between processes, rather than copied into each one.
+
+    Stands in for the docstore of a LangChain FAISS vector store: search looks up
+    chunks by docstore id, and index_to_docstore_id maps FAISS ids to docstore ids.
+    The store is read-only, so indexes that use it can't be updated.
+    """
+
+    def __init__(self, path):
+        import mmap
+
+        import numpy as np
+
+        self.faiss_ids, self.starts, self.ends = np.load(
+            _with_suffix(path, ".npy"), mmap_mode="r"
+        )
+        with open(_with_suffix(path, ".jsonl"), "rb") as f:
+            size = f.seek(0, 2)
+            self._data = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            )
+        self.index_to_docstore_id = DocstoreIds(self)
+        self._rows_by_docstore_id = None
+
+    def __len__(self):
+        return len(self.faiss_ids)
+
+    def get(self, faiss_id):
+        """Reads the Document for a chunk by its FAISS id."""
+        from langchain.docstore.document import Document
+
+        record = self._record(self._row(faiss_id))
+        return Document(
+            page_content=record["page_content"], metadata=record["metadata"]
+        )
+
+    def search(self, docstore_id):
+        """Reads the Document for a chunk by its docstore id, like a LangChain docstore.
+
+        The first search scans the whole store to index it by docstore id, so prefer
+        get, which needs no scan.
+        """
+        if self._rows_by_docstore_id is None:
+            self._rows_by_docstore_id = {
+                record["id"]: row for row, record in enumerate(self._records())
+            }
+        row = self._rows_by_docstore_id.get(docstore_id)
+        if row is None:
+            return f"ID {docstore_id} not found."
+        return self.get(int(self.faiss_ids[row]))
+
+    def items(self):
+        """Yields the (FAISS id, docstore id, Document) of every chunk, by FAISS id."""
+        from langchain.docstore.document import Document
+
+        for faiss_id, record in zip(self.faiss_ids, self._records()):
+            document = Document(
+                page_content=record["page_content"], metadata=record["metadata"]
+            )
+            yield int(faiss_id), record["id"], document
+
+    def _row(self, faiss_id):
+        import numpy as np
+
+        row = int(np.searchsorted(self.faiss_ids, faiss_id))
+        if row == len(self.faiss_ids) or self.faiss_ids[row] != faiss_id:
+            raise KeyError(faiss_id)
+        return row
+
+    def _record(self, row):
+        return json.loads(self._data[self.starts[row] : self.ends[row]])
+
+    def _records(self):
+        for row in range(len(self)):
+            yield self._record(row)
+
+
+class DocstoreIds(Mapping):
+    """A read-only view of a ChunkStore as a mapping from FAISS id to docstore id."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, faiss_id):
+        return self.store._record(self.store._row(faiss_id))["id"]
+
+    def __iter__(self):
+        return (int(faiss_id) for faiss_id in self.store.faiss_ids)
+
+    def __len__(self):
+        return len(self.store)
+
+
+def _with_suffix(path, suffix):
+    path = Path(path)
+    return path.with_name(path.name + suffix)
@@ -1,5 +1,31 @@
 """Functions to connect to a document store and fetch documents from it."""
-CONFIG = {"MONGO_DATABASE": "fsdl-dev", "MONGO_COLLECTION": "ask-fsdl"}
+import os
+import threading
+
+CONFIG = {
+    "MONGO_DATABASE": "fsdl-dev",
+    "MONGO_COLLECTION": "ask-fsdl",
+    "READ_BATCH_SIZE": 1000,  # documents fetched per round trip by stream_documents
+    "PREFETCH_BATCHES": 4,  # batches each parallel reader of a range keeps ready
+    "MANIFEST_SUFFIX": "-manifest",  # names the ETL manifest kept beside a collection
+}
+
+# settings for the shared client's connection pool, overridable from the environment
+POOL_CONFIG = {
+    "maxPoolSize": int(os.environ.get("MONGODB_MAX_POOL_SIZE", 32)),
+    "minPoolSize": int(os.environ.get("MONGODB_MIN_POOL_SIZE", 0)),
+    "maxIdleTimeMS": int(os.environ.get("MONGODB_MAX_IDLE_TIME_MS", 300_000)),
+    "connectTimeoutMS": int(os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", 10_000)),
+    "socketTimeoutMS": int(os.environ.get("MONGODB_SOCKET_TIMEOUT_MS", 60_000)),
+    "serverSelectionTimeoutMS": int(
+        os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 10_000)
+    ),
+}
+
+# process-wide state: one client, created on first use and shared by all calls
+_client = None
+_client_lock = threading.Lock()
+_client_stats = {"created": 0, "reused": 0}
 
 
 def get_documents(collection=None, db=None, client=None, query=None):
@@ -12,13 +38,145 @@ def get_documents(collection=None, db=None, client=None, query=None):
     return docs
 
 
+def stream_documents(
+    collection=None,
+    db=None,
+    client=None,
+    query=None,
+    fields=("text", "metadata"),
+    batch_size=None,
+    workers=1,
+    as_tuples=False,
+):
+    """Streams documents from a document database, fetching only some fields.
+
+    The server projects each document down to the given fields and sends them
+    batch_size at a time. With more than one worker, the collection is split into
+    ranges of _id that are read in parallel. Documents are still yielded in
+    order of _id: later ranges are read ahead, up to PREFETCH_BATCHES batches
+    each, while earlier ones are yielded. So runs over the same documents yield
+    them in the same order, whichever reader is quickest.
+
+    Arguments:
+        fields: The fields to fetch, which may be dotted paths, like "metadata.sha256".
+        batch_size: The number of documents fetched per round trip.
+        workers: The number of ranges, and threads, to read at once.
+        as_tuples: If True, yields a tuple of the values of the fields, in order,
+            rather than a dict, which is quicker for callers to unpack.
+    """
+    collection = get_collection(collection, db, client)
+    query = query or {"metadata.ignore": False}
+    projection = dict.fromkeys(fields, 1)
+    projection.setdefault("_id", 0)
+    batch_size = batch_size or CONFIG["READ_BATCH_SIZE"]
+
+    def convert(document):
+        return tuple(_get_path(document, field) for field in fields)
+
+    if workers <= 1:
+        documents = collection.find(query, projection, batch_size=batch_size)
+        yield from map(convert, documents) if as_tuples else documents
+        return
+
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    ranges = _id_ranges(collection, query, workers)
+    if not ranges:
+        return
+    # each range is read into its own queue, and the queues are drained in order
+    queues = [queue.Queue(maxsize=CONFIG["PREFETCH_BATCHES"]) for _ in ranges]
+    done, stop = object(), threading.Event()
+
+    def put(batches, item):  # gives up if the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                return batches.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+    def read(batches, lower, upper):
+        id_range = {"$gte": lower} if upper is None else {"$gte": lower, "$lt": upper}
+        cursor = collection.find(
+            {"$and": [query, {"_id": id_range}]},
+            dict(projection),
+            batch_size=batch_size,
+        ).sort("_id", 1)
+        try:
+            batch = []
+            for document in cursor:
+                batch.append(convert(document) if as_tuples else document)
+                if len(batch) >= batch_size:
+                    put(batches, batch)
+                    batch = []
+                if stop.is_set():
+                    return
+            put(batches, batch)
+        finally:
+            cursor.close()
+            put(batches, done)
+
+    with ThreadPoolExecutor(len(ranges)) as pool:
+        futures = [
+            pool.submit(read, batches, lower, upper)
+            for batches, (lower, upper) in zip(queues, ranges)
+        ]
+        try:
+            for batches in queues:
+                while (batch := batches.get()) is not done:
+                    yield from batch
+        finally:
+            stop.set()
+        for future in futures:
+            future.result()  # raises any error from the readers
+
+
+def _id_ranges(collection, query, n_ranges):
+    """Splits the documents matching a query into ranges of _id of similar sizes."""
+    count = collection.count_documents(query)
+    bounds = []
+    for ii in range(n_ranges):
+        start = (
+            collection.find(query, {"_id": 1})
+            .sort("_id", 1)
+            .skip(ii * count // n_ranges)
+        )
+        first = next(start.limit(1), None)
+        if first is not None and first["_id"] not in bounds:
+            bounds.append(first["_id"])
+
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def _get_path(document, path):
+    for key in path.split("."):
+        document = document.get(key) if document is not None else None
+    return document
+
+
 def drop(collection=None, db=None, client=None):
-    """Drops a collection from the database."""
+    """Drops a collection from the database, along with its ETL manifest."""
+    get_manifest(collection, db, client).drop()
     collection = get_collection(collection, db, client)
 
     collection.drop()
 
 
+def get_manifest(collection=None, db=None, client=None):
+    """Accesses the ETL manifest of a collection, which records the sources in it.
+
+    Each entry is keyed on a source's URL and holds what was last seen of it, like
+    its ETag and content hash, and the hashes of the documents made from it.
+    """
+    import pymongo
+
+    if isinstance(collection, pymongo.collection.Collection):
+        db, collection = collection.database, collection.name
+    collection = collection or CONFIG["MONGO_COLLECTION"]
+
+    return get_collection(collection + CONFIG["MANIFEST_SUFFIX"], db, client)
+
+
 def query(query, projection=None, collection=None, db=None):
     """Runs a query against the document db and returns a list of results."""
     import docstore
@@ -56,19 +214,63 @@ def get_database(db=None, client=None):
     """Accesses a specific database in the document store."""
     import pymongo
 
-    client = client or connect()
-
     db = db or CONFIG["MONGO_DATABASE"]
     if isinstance(db, pymongo.database.Database):
         return db
     else:
+        client = client or get_client()
         db = client.get_database(db)
         return db
 
 
-def connect(user=None, password=None, uri=None):
-    """Connects to the document store, here MongoDB."""
-    import os
+def get_client():
+    """Returns the process's shared MongoDB client, creating it on first use.
+
+    The client holds a pool of connections, sized by POOL_CONFIG, that is reused
+    across calls, so only the first call pays for DNS lookups and TLS handshakes.
+    Clients are not safe to use across a fork, so a forked child makes its own.
+    """
+    global _client
+
+    client = _client
+    if client is not None:
+        _client_stats["reused"] += 1
+        return client
+
+    with _client_lock:
+        if _client is None:
+            _client = connect(connect_now=False, **POOL_CONFIG)
+            _client_stats["created"] += 1
+        else:
+            _client_stats["reused"] += 1
+
+    return _client
+
+
+def client_stats():
+    """Reports how many times the shared client was created and reused."""
+    return dict(_client_stats)
+
+
+def _reset_client():
+    """Forgets the parent's client in a forked child, without closing its sockets."""
+    global _client, _client_lock
+
+    _client, _client_lock = None, threading.Lock()
+    _client_stats.update(created=0, reused=0)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client)
+
+
+def connect(user=None, password=None, uri=None, connect_now=True, **kwargs):
+    """Connects to the document store, here MongoDB.
+
+    Creates a new client each time, so prefer get_client. kwargs are passed on to
+    pymongo.MongoClient, e.g. to configure its connection pool. Without connect_now,
+    the client connects in the background on first use.
+    """
     import urllib
 
     import pymongo
@@ -83,6 +285,8 @@ def connect(user=None, password=None, uri=None):
 
     connection_string = f"mongodb+srv://{mongodb_user}:{mongodb_password}@{mongodb_host}/?retryWrites=true&w=majority"
 
-    client = pymongo.MongoClient(connection_string, connect=True, appname="ask-fsdl")
+    client = pymongo.MongoClient(
+        connection_string, connect=connect_now, appname="ask-fsdl", **kwargs
+    )
 
     return client
@@ -0,0 +1,296 @@
+"""An async scheduler for embedding requests to the OpenAI API during index builds."""
+import asyncio
+import os
+import random
+import re
+import time
+import weakref
+
+from utils import pretty_log
+
+CONFIG = {
+    "API_BASE": "https://api.openai.com/v1",
+    "MAX_CONCURRENCY": 16,  # upper limit on requests in flight
+    "REQUEST_SIZE": 64,  # texts per request
+    "TOKENS_PER_MINUTE": 1_000_000,  # client-side token budget
+    "MAX_RETRIES": 8,
+}
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncEmbedder:
+    """Embeds texts with many concurrent requests, within rate limits.
+
+    Texts are split into requests of REQUEST_SIZE texts, which are kept in flight
+    up to an adaptive concurrency limit. The limit is halved whenever the API
+    reports a rate limit and grows back by one after a run of successes.
+
+    A token bucket, refilled at tokens_per_minute and filled from tiktoken counts,
+    keeps requests under the token quota before the API has to refuse them. The
+    bucket is also lowered to the remaining-tokens count reported by the API.
+
+    Failed requests are retried with exponential backoff, on their own, so a
+    transient error does not restart the rest of the build.
+
+    Requests share one aiohttp session per event loop, so connections are kept
+    alive between calls. Sessions are created on first use and closed by close.
+
+    Exposes the embed_documents/embed_query interface of LangChain embeddings.
+    """
+
+    def __init__(
+        self,
+        model="text-embedding-ada-002",
+        api_base=None,
+        api_key=None,
+        max_concurrency=None,
+        request_size=None,
+        tokens_per_minute=None,
+        max_retries=None,
+        count_tokens=None,
+    ):
+        self.model = model
+        self.api_base = (api_base or CONFIG["API_BASE"]).rstrip("/")
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+        self.max_concurrency = max_concurrency or CONFIG["MAX_CONCURRENCY"]
+        self.request_size = request_size or CONFIG["REQUEST_SIZE"]
+        self.max_retries = max_retries or CONFIG["MAX_RETRIES"]
+        self.count_tokens = count_tokens or _tiktoken_counter(model)
+
+        self.bucket = TokenBucket(tokens_per_minute or CONFIG["TOKENS_PER_MINUTE"])
+        self.limiter = AdaptiveLimiter(self.max_concurrency)
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "tokens": 0}
+        self._sessions = weakref.WeakKeyDictionary()  # event loop -> session
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts, blocking until all are done."""
+
+        async def embed():  # on a loop of its own, so its session is closed after
+            try:
+                return await self.aembed_documents(texts)
+            finally:
+                await self.aclose()
+
+        return _run(embed())
+
+    def embed_query(self, text):
+        """Embeds a single text, blocking until it is done."""
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        """Embeds a list of texts with concurrent requests, preserving order."""
+        batches = [
+            texts[ii : ii + self.request_size]
+            for ii in range(0, len(texts), self.request_size)
+        ]
+        session = self._get_session()
+        results = await asyncio.gather(
+            *(self._embed_batch(session, batch) for batch in batches)
+        )
+
+        return [embedding for result in results for embedding in result]
+
+    async def aembed_query(self, text):
+        """Embeds a single text."""
+        return (await self.aembed_documents([text]))[0]
+
+    async def aclose(self):
+        """Closes the session of the running event loop, if there is one."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close(self):
+        """Closes the sessions of all event loops, e.g. when the container exits.
+
+        Sessions of loops that are still running, or already closed, are left to
+        be cleaned up with their loops.
+        """
+        for loop, session in list(self._sessions.items()):
+            if not (loop.is_closed() or loop.is_running()):
+                loop.run_until_complete(session.close())
+        self._sessions.clear()
+
+    def _get_session(self):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:  # sessions are bound to one loop
+            session = self._sessions[loop] = aiohttp.ClientSession()
+        return session
+
+    async def _embed_batch(self, session, texts):
+        import aiohttp
+
+        tokens = sum(self.count_tokens(text) for text in texts)
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(tokens)
+            async with self.limiter:
+                try:
+                    status, headers, body = await self._post(session, texts)
+                # e.g., a kept-alive connection that the server has since closed
+                except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    status, headers, body = None, {}, repr(e)
+
+            self.bucket.observe(headers)
+            if status == 200:
+                self.limiter.succeeded()
+                self.stats["requests"] += 1
+                self.stats["tokens"] += tokens
+                data = sorted(body["data"], key=lambda item: item["index"])
+                return [item["embedding"] for item in data]
+
+            if status is not None and status not in RETRYABLE_STATUSES:
+                raise RuntimeError(f"embedding request failed with {status}: {body}")
+            if status == 429:
+                self.stats["rate_limited"] += 1
+                self.limiter.throttled()
+            if attempt == self.max_retries:
+                break
+
+            self.stats["retries"] += 1
+            delay = _retry_delay(headers, attempt)
+            pretty_log(
+                f"embedding request got {status or body}, retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+        raise RuntimeError(f"embedding request failed after {self.max_retries} retries")
+
+    async def _post(self, session, texts):
+        import aiohttp
+
+        async with session.post(
+            f"{self.api_base}/embeddings",
+            json={"model": self.model, "input": texts},
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            timeout=aiohttp.ClientTimeout(total=60),
+        ) as response:
+            if response.status == 200:
+                body = await response.json()
+            else:
+                body = await response.text()
+            return response.status, response.headers, body
+
+
+class TokenBucket:
+    """Limits the rate at which tokens are spent, refilling continuously."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self._lock, self._loop = None, None
+
+    async def acquire(self, tokens):
+        """Waits until the bucket holds enough tokens, then takes them."""
+        tokens = min(tokens, self.capacity)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:  # asyncio primitives are bound to one loop
+            self._lock, self._loop = asyncio.Lock(), loop
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def observe(self, headers):
+        """Lowers the bucket to the remaining tokens reported by the API."""
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining is not None:
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+
+class AdaptiveLimiter:
+    """Limits concurrency, halving on rate limits and growing back on success."""
+
+    def __init__(self, max_concurrency, growth_after=8):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.growth_after = growth_after
+        self._successes = 0
+        self._condition, self._loop = None, None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:  # asyncio primitives are bound to one loop
+            self._condition, self._loop = asyncio.Condition(), loop
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        self._successes = 0
+        self.limit = max(1, self.limit // 2)
+
+    def succeeded(self):
+        self._successes += 1
+        if self._successes >= self.growth_after and self.limit < self.max_concurrency:
+            self._successes = 0
+            self.limit += 1
+
+
+def _retry_delay(headers, attempt):
+    """Uses the API's hints about when to retry, else exponential backoff."""
+    for header in ("retry-after-ms", "retry-after", "x-ratelimit-reset-tokens"):
+        value = headers.get(header)
+        if value:
+            seconds = _parse_duration(value, milliseconds=header.endswith("-ms"))
+            if seconds is not None:
+                return seconds + random.uniform(0, 0.25)
+    return min(60.0, 2**attempt) * random.uniform(0.5, 1.0)
+
+
+def _parse_duration(value, milliseconds=False):
+    """Parses durations like "20ms", "1.5s", "6m0s", or a bare number."""
+    try:
+        seconds = float(value)
+        return seconds / 1000 if milliseconds else seconds
+    except ValueError:
+        pass
+
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def _tiktoken_counter(model):
+    import tiktoken
+
+    encoding = tiktoken.encoding_for_model(model)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _run(coroutine):
+    """Runs a coroutine to completion, even if called from within an event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    import concurrent.futures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
@@ -24,13 +24,18 @@ stub = modal.Stub(
 
 # run simple coordinating code locally, with dependency-inducing processing in the cloud
 @stub.local_entrypoint()
-def main(json_path="data/lectures-2022.json", collection=None, db=None):
+def main(json_path="data/lectures-2022.json", collection=None, db=None, refresh=False):
     """Calls the ETL pipeline using a JSON file with markdown file metadata.
 
+    Lectures whose Markdown is unchanged since the last run, according to the ETL
+    manifest, are skipped, unless refresh is set.
+
     modal run etl/markdown.py --json-path /path/to/json
     """
     import json
 
+    from utils import pretty_log
+
     with open(json_path) as f:
         markdown_corpus = json.load(f)
 
@@ -40,24 +45,37 @@ def main(json_path="data/lectures-2022.json", collection=None, db=None):
     )
 
     lectures = markdown_corpus["lectures"]
+    sources = [f"{md_url}/{lecture['slug']}/index.md" for lecture in lectures]
+
+    with etl.shared.stub.run():
+        manifest = etl.shared.read_manifest.remote(collection=collection, db=db)
+        probes = list(
+            etl.shared.probe_source.map(
+                sources, [manifest.get(source) for source in sources]
+            )
+        )
+        changed = [ii for ii, probe in enumerate(probes) if refresh or probe["changed"]]
+        pretty_log(f"{len(changed)} of {len(lectures)} lectures changed")
 
-    documents = (
-        etl.shared.unchunk(  # each lecture creates multiple documents, so we flatten
+        documents, entries = etl.shared.collect_documents(
+            [sources[ii] for ii in changed],
             to_documents.map(
-                lectures,
+                [lectures[ii] for ii in changed],
                 kwargs={"website_url": website_url, "md_url": md_url},
                 return_exceptions=True,
-            )
+            ),
+            etag=[probes[ii]["etag"] for ii in changed],
+            last_modified=[probes[ii]["last_modified"] for ii in changed],
         )
-    )
 
-    with etl.shared.stub.run():
-        chunked_documents = etl.shared.chunk_into(documents, 10)
-        list(
-            etl.shared.add_to_document_db.map(
-                chunked_documents, kwargs={"db": db, "collection": collection}
+        if documents:
+            chunked_documents = etl.shared.chunk_into(documents, 10)
+            list(
+                etl.shared.add_to_document_db.map(
+                    chunked_documents, kwargs={"db": db, "collection": collection}
+                )
             )
-        )
+        etl.shared.update_manifest.remote(entries, collection=collection, db=db)
 
 
 @stub.function(image=image)
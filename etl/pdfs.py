@@ -22,14 +22,20 @@ stub = modal.Stub(
 
 
 @stub.local_entrypoint()
-def main(json_path="data/llm-papers.json", collection=None, db=None):
+def main(json_path="data/llm-papers.json", collection=None, db=None, refresh=False):
     """Calls the ETL pipeline using a JSON file with PDF metadata.
 
+    Papers whose PDFs are unchanged since the last run, according to the ETL
+    manifest, are skipped, unless refresh is set. Unchanged PDFs are not
+    downloaded, nor their metadata looked up on arXiv.
+
     modal run etl/pdfs.py --json-path /path/to/json
     """
     import json
     from pathlib import Path
 
+    from utils import pretty_log
+
     json_path = Path(json_path).resolve()
 
     if not json_path.exists():
@@ -42,17 +48,37 @@ def main(json_path="data/llm-papers.json", collection=None, db=None):
     with open(json_path) as f:
         paper_data = json.load(f)
 
-    paper_data = get_pdf_url.map(paper_data, return_exceptions=True)
-
-    documents = etl.shared.unchunk(extract_pdf.map(paper_data, return_exceptions=True))
+    paper_data = list(get_pdf_url.map(paper_data, return_exceptions=True))
+    # papers without PDFs make no documents, so they are left out
+    paper_data = [p for p in paper_data if isinstance(p, dict) and p["pdf_url"]]
+    sources = [paper.get("url", paper["pdf_url"]) for paper in paper_data]
 
     with etl.shared.stub.run():
-        chunked_documents = etl.shared.chunk_into(documents, 10)
-        list(
-            etl.shared.add_to_document_db.map(
-                chunked_documents, kwargs={"db": db, "collection": collection}
+        manifest = etl.shared.read_manifest.remote(collection=collection, db=db)
+        probes = list(
+            etl.shared.probe_source.map(
+                [paper["pdf_url"] for paper in paper_data],
+                [manifest.get(source) for source in sources],
             )
         )
+        changed = [ii for ii, probe in enumerate(probes) if refresh or probe["changed"]]
+        pretty_log(f"{len(changed)} of {len(paper_data)} papers changed")
+
+        documents, entries = etl.shared.collect_documents(
+            [sources[ii] for ii in changed],
+            extract_pdf.map([paper_data[ii] for ii in changed], return_exceptions=True),
+            etag=[probes[ii]["etag"] for ii in changed],
+            last_modified=[probes[ii]["last_modified"] for ii in changed],
+        )
+
+        if documents:
+            chunked_documents = etl.shared.chunk_into(documents, 10)
+            list(
+                etl.shared.add_to_document_db.map(
+                    chunked_documents, kwargs={"db": db, "collection": collection}
+                )
+            )
+        etl.shared.update_manifest.remote(entries, collection=collection, db=db)
 
 
 @stub.function(
@@ -134,7 +160,7 @@ def fetch_papers(collection_name="all-content"):
     """Fetches papers from the LLM Lit Review, https://tfs.ai/llm-lit-review."""
     import docstore
 
-    client = docstore.connect()
+    client = docstore.get_client()
 
     collection = client.get_database("llm-lit-review").get_collection(collection_name)
 
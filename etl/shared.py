@@ -18,26 +18,271 @@ stub = modal.Stub(
 )
 
 
+# bulk writes are sent once they reach either limit, so batches adapt to doc sizes
+MAX_BATCH_BYTES = 4 * 2**20  # well under MongoDB's 48 MB limit on messages
+MAX_BATCH_DOCUMENTS = 1000
+MAX_CONCURRENT_BATCHES = 4  # bulk writes in flight at once from each container
+
+
 @stub.function(image=image)
 def add_to_document_db(documents_json, collection=None, db=None):
-    """Adds a collection of json documents to a database."""
-    from pymongo import InsertOne
+    """Adds a collection of json documents to a database, keyed on their hashes.
+
+    Each document is upserted by its metadata.sha256, so rerunning the ETL updates
+    documents in place rather than duplicating them, and documents that have not
+    changed are matched but not written. A unique index on the hash is created if
+    needed. Unordered bulk writes are sent concurrently, in batches sized by
+    their encoded bytes.
+
+    Returns:
+        A dict of counts and throughput for the writes.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    import bson
+    from pymongo import UpdateOne
 
     import docstore
+    from utils import pretty_log
 
     collection = docstore.get_collection(collection, db)
+    ensure_hash_index(collection)
+
+    start = time.monotonic()
+    stats = {"documents": 0, "bytes": 0, "batches": 0}
+    stats.update(inserted=0, updated=0, unchanged=0)
+
+    def batches():
+        batch, batch_bytes = [], 0
+        for document in documents_json:
+            document = {key: value for key, value in document.items() if key != "_id"}
+            size = len(bson.encode(document))
+            if batch and (
+                batch_bytes + size > MAX_BATCH_BYTES
+                or len(batch) >= MAX_BATCH_DOCUMENTS
+            ):
+                yield batch, batch_bytes
+                batch, batch_bytes = [], 0
+            key = {"metadata.sha256": document["metadata"]["sha256"]}
+            batch.append(UpdateOne(key, {"$set": document}, upsert=True))
+            batch_bytes += size
+        if batch:
+            yield batch, batch_bytes
+
+    with ThreadPoolExecutor(MAX_CONCURRENT_BATCHES) as pool:
+        futures = [
+            (pool.submit(_bulk_upsert, collection, batch), len(batch), batch_bytes)
+            for batch, batch_bytes in batches()
+        ]
+        for future, n_documents, batch_bytes in futures:
+            for key, count in future.result().items():
+                stats[key] += count
+            stats["documents"] += n_documents
+            stats["bytes"] += batch_bytes
+            stats["batches"] += 1
+
+    stats["seconds"] = round(time.monotonic() - start, 3)
+    stats["docs_per_s"] = round(stats["documents"] / max(stats["seconds"], 1e-6), 1)
+    pretty_log(
+        f"upserted {stats['documents']} documents in {stats['batches']} batches:"
+        f" {stats['inserted']} new, {stats['updated']} updated,"
+        f" {stats['unchanged']} unchanged, {stats['docs_per_s']} docs/s"
+    )
+
+    return stats
+
+
+def ensure_hash_index(collection):
+    """Creates a unique index on document hashes, if the collection allows it."""
+    from pymongo.errors import OperationFailure
+
+    from utils import pretty_log
+
+    try:
+        collection.create_index("metadata.sha256", unique=True)
+    except OperationFailure as e:  # e.g., duplicates written before upserts
+        pretty_log(f"could not create unique index on metadata.sha256: {e}")
+
+
+def _bulk_upsert(collection, requests, retry=True):
+    """Sends one unordered bulk write, counting inserts, updates and no-ops.
+
+    Two containers may upsert the same new hash at once, in which case one of
+    them fails on the unique index. Its writes are retried once, as updates.
+    """
+    from pymongo.errors import BulkWriteError
+
+    try:
+        result = collection.bulk_write(requests, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        errors = result["writeErrors"]
+        duplicates = [
+            requests[error["index"]] for error in errors if error["code"] == 11000
+        ]
+        if not retry or len(duplicates) < len(errors):
+            raise
+        retried = _bulk_upsert(collection, duplicates, retry=False)
+        result = dict(
+            result,
+            nUpserted=result["nUpserted"] + retried["inserted"],
+            nMatched=result["nMatched"] + retried["updated"] + retried["unchanged"],
+            nModified=result["nModified"] + retried["updated"],
+        )
+
+    return {
+        "inserted": result["nUpserted"],
+        "updated": result["nModified"],
+        "unchanged": result["nMatched"] - result["nModified"],
+    }
+
+
+@stub.function(image=image)
+def read_manifest(collection=None, db=None):
+    """Reads the ETL manifest of a collection, as a dict keyed on source URLs."""
+    import docstore
+
+    manifest = docstore.get_manifest(collection, db)
+
+    return {entry["_id"]: entry for entry in manifest.find({})}
+
+
+@stub.function(image=image)
+def update_manifest(entries, collection=None, db=None):
+    """Records extracted sources in the ETL manifest and removes stale documents.
+
+    Documents that a source made last time but not this time are deleted, unless
+    another source in the manifest also made them.
+
+    Returns:
+        The number of stale documents deleted.
+    """
+    from pymongo import ReplaceOne
+
+    import docstore
+    from utils import pretty_log
+
+    if not entries:
+        return 0
+    manifest = docstore.get_manifest(collection, db)
+    sources = [entry["_id"] for entry in entries]
+
+    previous = {
+        entry["_id"]: entry["document_hashes"]
+        for entry in manifest.find({"_id": {"$in": sources}}, {"document_hashes": 1})
+    }
+    stale = set()
+    for entry in entries:
+        stale |= set(previous.get(entry["_id"], [])) - set(entry["document_hashes"])
+
+    manifest.bulk_write(
+        [ReplaceOne({"_id": entry["_id"]}, entry, upsert=True) for entry in entries],
+        ordered=False,
+    )
+
+    if stale:
+        shared = manifest.find(
+            {"document_hashes": {"$in": list(stale)}}, {"document_hashes": 1}
+        )
+        for entry in shared:
+            stale -= set(entry["document_hashes"])
+    deleted = 0
+    if stale:
+        documents = docstore.get_collection(collection, db)
+        result = documents.delete_many({"metadata.sha256": {"$in": list(stale)}})
+        deleted = result.deleted_count
+
+    pretty_log(f"recorded {len(entries)} sources, deleted {deleted} stale documents")
+
+    return deleted
+
+
+@stub.function(image=image)
+def probe_source(url, entry=None):
+    """Checks whether a source has changed since its manifest entry was recorded.
+
+    Sends a conditional HEAD request with the recorded ETag and Last-Modified
+    headers, so unchanged sources are detected without downloading them.
+    Sources that can't be checked are treated as changed.
+
+    Returns:
+        A dict with the source's current validators and whether it has changed.
+    """
+    import requests
+
+    entry = entry or {}
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = requests.head(url, headers=headers, allow_redirects=True, timeout=10)
+    except requests.RequestException:
+        return {"changed": True, "etag": None, "last_modified": None}
+
+    etag, last_modified = entry.get("etag"), entry.get("last_modified")
+    if response.status_code == 304:
+        changed = False
+    elif response.ok:  # some servers ignore conditions, but still send validators
+        current = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        changed = not any(current) or current != (etag, last_modified)
+        etag, last_modified = current
+    else:
+        changed, etag, last_modified = True, None, None
+
+    return {"changed": changed, "etag": etag, "last_modified": last_modified}
+
+
+def manifest_entry(source, documents, **validators):
+    """Makes the manifest entry for a source from the documents extracted from it.
+
+    The content hash is taken over the documents' hashes, so it changes only when
+    the extracted text does. Extra validators, like an ETag, are stored as is.
+    """
+    import datetime
+    import hashlib
+
+    document_hashes = sorted({doc["metadata"]["sha256"] for doc in documents})
+    content_hash = hashlib.sha256("\n".join(document_hashes).encode("utf-8"))
+
+    return {
+        "_id": source,
+        **validators,
+        "content_hash": content_hash.hexdigest(),
+        "document_hashes": document_hashes,
+        "updated_at": datetime.datetime.now(datetime.timezone.utc),
+    }
+
+
+def collect_documents(sources, results, **validators):
+    """Gathers the documents extracted from sources, with their manifest entries.
+
+    Sources whose extraction failed or made no documents get no entry, so they are
+    tried again on the next run.
 
-    requesting, CHUNK_SIZE = [], 250
+    Arguments:
+        results: The results of mapping an extraction function over the sources,
+            with return_exceptions=True.
+        validators: Lists of values, like ETags, to store for each source.
 
-    for document in documents_json:
-        requesting.append(InsertOne(document))
+    Returns:
+        A list of documents and a list of manifest entries.
+    """
+    from utils import pretty_log
 
-        if len(requesting) >= CHUNK_SIZE:
-            collection.bulk_write(requesting)
-            requesting = []
+    documents, entries = [], []
+    for ii, (source, result) in enumerate(zip(sources, results)):
+        if isinstance(result, BaseException) or not result:
+            pretty_log(f"no documents from {source}: {result!r}")
+            continue
+        documents += result
+        values = {key: values[ii] for key, values in validators.items()}
+        entries.append(manifest_entry(source, result, **values))
 
-    if requesting:
-        collection.bulk_write(requesting)
+    return documents, entries
 
 
 def enrich_metadata(pages):
@@ -19,30 +19,50 @@ stub = modal.Stub(
 
 
 @stub.local_entrypoint()
-def main(json_path="data/videos.json", collection=None, db=None):
+def main(json_path="data/videos.json", collection=None, db=None, refresh=False):
     """Calls the ETL pipeline using a JSON file with YouTube video metadata.
 
+    Transcripts of published videos rarely change and can't be checked without
+    fetching them, so videos already in the ETL manifest under the same title are
+    skipped, unless refresh is set.
+
     modal run etl/videos.py --json-path /path/to/json
     """
     import json
 
+    from utils import pretty_log
+
     with open(json_path) as f:
         video_infos = json.load(f)
 
-    documents = (
-        etl.shared.unchunk(  # each video creates multiple documents, so we flatten
-            extract_subtitles.map(video_infos, return_exceptions=True)
-        )
-    )
+    sources = [f"https://www.youtube.com/watch?v={info['id']}" for info in video_infos]
 
     with etl.shared.stub.run():
-        chunked_documents = etl.shared.chunk_into(documents, 10)
-        list(
-            etl.shared.add_to_document_db.map(
-                chunked_documents, kwargs={"db": db, "collection": collection}
-            )
+        manifest = etl.shared.read_manifest.remote(collection=collection, db=db)
+        changed = [
+            ii
+            for ii, (source, info) in enumerate(zip(sources, video_infos))
+            if refresh or manifest.get(source, {}).get("title") != info["title"]
+        ]
+        pretty_log(f"{len(changed)} of {len(video_infos)} videos changed")
+
+        documents, entries = etl.shared.collect_documents(
+            [sources[ii] for ii in changed],
+            extract_subtitles.map(
+                [video_infos[ii] for ii in changed], return_exceptions=True
+            ),
+            title=[video_infos[ii]["title"] for ii in changed],
         )
 
+        if documents:
+            chunked_documents = etl.shared.chunk_into(documents, 10)
+            list(
+                etl.shared.add_to_document_db.map(
+                    chunked_documents, kwargs={"db": db, "collection": collection}
+                )
+            )
+        etl.shared.update_manifest.remote(entries, collection=collection, db=db)
+
 
 @stub.function(
     retries=modal.Retries(max_retries=3, backoff_coefficient=2.0, initial_delay=5.0)
@@ -0,0 +1,154 @@
+"""Precomputed metadata filters over the chunks of a vector index."""
+import re
+
+# metadata fields that searches can be filtered on
+FIELDS = ("source_type", "title", "year")
+# values of the source_type field
+SOURCE_TYPES = ("video", "paper", "lecture", "other")
+# fields matched by case-insensitive substring, rather than exactly
+SUBSTRING_FIELDS = {"title"}
+# most distinct filters whose masks and selectors are kept
+MAX_CACHED_FILTERS = 256
+
+
+def source_type(metadata):
+    """Classifies a chunk as a "video", "paper", "lecture" or "other" by its source."""
+    source = metadata.get("source") or ""
+    if "youtube.com" in source or "youtu.be" in source:
+        return "video"
+    if metadata.get("arxiv_id") or "arxiv.org" in source or source.endswith(".pdf"):
+        return "paper"
+    if "fullstackdeeplearning.com" in source:
+        return "lecture"
+    return "other"
+
+
+def field_values(metadata):
+    """Extracts the normalized value of each filterable field from chunk metadata."""
+    year = re.search(r"/(20\d\d)/", metadata.get("source") or "")
+    if year is None and metadata.get("date"):
+        year = re.match(r"(\d{4})", str(metadata["date"]))
+    return {
+        "source_type": source_type(metadata),
+        "title": " ".join((metadata.get("title") or "").lower().split()),
+        "year": year.group(1) if year else "",
+    }
+
+
+class FilterIndex:
+    """Bitsets over the chunks of an index, one for each value of each field.
+
+    Bit i of a bitset is set if the chunk in row i has that value. Rows follow the
+    same order as the index's SparseIndex, so row masks apply to BM25 directly, and
+    are mapped to FAISS ids to build ID selectors for vector search. Masks and
+    selectors are cached per filter, so repeated filters cost nothing to set up.
+    """
+
+    def __init__(self, ids, values, bitsets):
+        self.ids = ids  # row -> FAISS id
+        self.values = values  # field -> list of values, aligned with bitsets
+        self.bitsets = bitsets  # field -> packed bits, one row per value
+        self._masks, self._selectors = {}, {}
+
+    @classmethod
+    def build(cls, chunks):
+        """Builds the bitsets from (FAISS id, metadata) pairs."""
+        import numpy as np
+
+        ids, rows_by_value = [], {field: {} for field in FIELDS}
+        for row, (faiss_id, metadata) in enumerate(chunks):
+            ids.append(faiss_id)
+            for field, value in field_values(metadata).items():
+                rows_by_value[field].setdefault(value, []).append(row)
+
+        values, bitsets = {}, {}
+        for field, rows in rows_by_value.items():
+            values[field] = sorted(rows)
+            bits = np.zeros((len(values[field]), len(ids)), dtype=bool)
+            for ii, value in enumerate(values[field]):
+                bits[ii, rows[value]] = True
+            bitsets[field] = np.packbits(bits, axis=1)
+
+        return cls(np.array(ids, dtype="int64"), values, bitsets)
+
+    def mask(self, filter):
+        """Returns a boolean mask over rows of the chunks that pass a filter.
+
+        Arguments:
+            filter: A dict from field to a value or list of values. A chunk passes
+                if, for every field, it matches any of the values.
+        """
+        import numpy as np
+
+        key = _filter_key(filter)
+        if key not in self._masks:
+            mask = np.ones(len(self.ids), dtype=bool)
+            for field, wanted in key:
+                if field not in self.values:
+                    raise ValueError(f"can't filter on {field}, try one of {FIELDS}")
+                matches = [
+                    ii
+                    for ii, value in enumerate(self.values[field])
+                    if any(_matches(field, value, w) for w in wanted)
+                ]
+                bits = np.zeros(self.bitsets[field].shape[1], dtype="uint8")
+                for ii in matches:
+                    bits |= self.bitsets[field][ii]
+                mask &= np.unpackbits(bits, count=len(self.ids)).astype(bool)
+            if len(self._masks) >= MAX_CACHED_FILTERS:
+                self._masks.clear()
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def selector(self, filter):
+        """Returns a FAISS ID selector for the chunks that pass a filter."""
+        import faiss
+
+        key = _filter_key(filter)
+        if key not in self._selectors:
+            ids = self.ids[self.mask(filter)]
+            if len(self._selectors) >= MAX_CACHED_FILTERS:
+                self._selectors.clear()
+            self._selectors[key] = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+        return self._selectors[key]
+
+    def save(self, path):
+        """Saves the bitsets and values in a single .npz file."""
+        import numpy as np
+
+        arrays = {"ids": self.ids}
+        for field in FIELDS:
+            arrays[f"{field}_bits"] = self.bitsets[field]
+            arrays[f"{field}_values"] = np.frombuffer(
+                "\n".join(self.values[field]).encode("utf-8"), dtype="uint8"
+            )
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        values, bitsets = {}, {}
+        with np.load(path) as arrays:
+            ids = arrays["ids"]
+            for field in FIELDS:
+                bitsets[field] = arrays[f"{field}_bits"]
+                values[field] = arrays[f"{field}_values"].tobytes().decode().split("\n")
+        return cls(ids, values, bitsets)
+
+
+def _filter_key(filter):
+    """Normalizes a filter into a hashable, canonical form."""
+    key = []
+    for field, wanted in sorted(filter.items()):
+        if wanted is None:
+            continue
+        wanted = [wanted] if isinstance(wanted, (str, int)) else wanted
+        key.append((field, tuple(sorted(str(w).strip().lower() for w in wanted))))
+    return tuple(key)
+
+
+def _matches(field, value, wanted):
+    if field in SUBSTRING_FIELDS:
+        return wanted in value
+    return value == wanted
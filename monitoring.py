@@ -0,0 +1,344 @@
+"""Monitoring for the Q&A pipeline: stage timings, metrics and Gantry logging.
+
+Interactions are logged to Gantry from a background thread, off the request path.
+Stage latencies and token counts are written out as JSON lines per request and
+kept as container-wide metrics, rendered in the Prometheus text format. Metrics
+are not shared between containers, so each only renders what it observed.
+"""
+import atexit
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from utils import pretty_log
+
+CONFIG = {
+    "APPLICATION": "ask-fsdl",
+    "MAX_QUEUE_SIZE": 4096,  # records waiting beyond this are dropped, not blocked on
+    "BATCH_SIZE": 64,  # records sent to Gantry per request
+    "FLUSH_INTERVAL": 5.0,  # longest, in seconds, a record waits before being sent
+}
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_logging_sink():
+    """Returns the container-wide logging sink, starting it on first use."""
+    global _sink
+
+    with _sink_lock:
+        if _sink is None:
+            _sink = GantrySink()
+            atexit.register(_sink.close)
+            register_collector("gantry_sink", lambda: _sink.stats)
+        return _sink
+
+
+class GantrySink:
+    """Batches records on a bounded in-memory queue and sends them to Gantry.
+
+    Callers only ever enqueue: building the Gantry payload and the network calls
+    happen on a background thread, so logging adds no latency to answers.
+
+    Batches are sent when BATCH_SIZE records are waiting or FLUSH_INTERVAL seconds
+    have passed, and whatever is left is sent when the container shuts down. If the
+    queue is full, say because Gantry is slow or down, new records are dropped and
+    counted rather than blocking the caller.
+    """
+
+    def __init__(self, application=None, max_queue_size=None, batch_size=None):
+        self.application = application or CONFIG["APPLICATION"]
+        self.batch_size = batch_size or CONFIG["BATCH_SIZE"]
+        self.flush_interval = CONFIG["FLUSH_INTERVAL"]
+        self.api_key = os.environ.get("GANTRY_API_KEY")
+        self.stats = {"queued": 0, "logged": 0, "dropped": 0, "failed": 0}
+
+        self._queue = queue.Queue(maxsize=max_queue_size or CONFIG["MAX_QUEUE_SIZE"])
+        self._client = None
+        self._closed = threading.Event()
+        self._thread = None
+
+        if not self.api_key:
+            pretty_log("No Gantry API key found, skipping logging")
+        else:
+            self._thread = threading.Thread(
+                target=self._run, name="gantry-sink", daemon=True
+            )
+            self._thread.start()
+
+    def log(self, query, sources, answer, request_id=None):
+        """Queues an interaction for logging. Never blocks."""
+        if self._thread is None or self._closed.is_set():
+            return False
+
+        record = (
+            query,
+            [source.page_content for source in sources],
+            [source.metadata["source"] for source in sources],
+            answer,
+            str(request_id) if request_id else None,
+        )
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+
+        self.stats["queued"] += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Waits until every queued record has been sent or has failed."""
+        if self._thread is None:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+
+    def close(self, timeout=10.0):
+        """Stops accepting records and sends the ones still queued."""
+        if self._thread is None or self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join(timeout)
+        pretty_log(f"gantry sink closed: {self.stats}")
+
+    def _run(self):
+        while not (self._closed.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._send(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self):
+        batch, deadline = [], time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._closed.is_set():
+                timeout = 0  # drain what's left without waiting
+            else:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                batch.append(self._queue.get(timeout=min(timeout, 0.5)))
+            except queue.Empty:
+                if self._closed.is_set() or time.monotonic() >= deadline:
+                    break
+        return batch
+
+    def _send(self, batch):
+        separator = "\n\n---\n\n"
+        inputs, outputs, join_keys = [], [], []
+        for query, docs, sources, answer, join_key in batch:
+            inputs.append(
+                {
+                    "question": query,
+                    "docs": separator.join(docs),
+                    "sources": separator.join(sources),
+                }
+            )
+            outputs.append({"answer_text": answer})
+            join_keys.append(join_key or uuid.uuid4().hex)
+
+        try:
+            client = self._get_client()
+            client.log_records(
+                application=self.application,
+                inputs=inputs,
+                outputs=outputs,
+                join_keys=join_keys,
+            )
+        except Exception as e:  # logging must never take the sink down
+            self.stats["failed"] += len(batch)
+            pretty_log(f"failed to log {len(batch)} records to gantry: {e}")
+        else:
+            self.stats["logged"] += len(batch)
+
+    def _get_client(self):
+        if self._client is None:
+            import gantry
+
+            gantry.init(api_key=self.api_key, environment="modal")
+            self._client = gantry
+        return self._client
+
+
+# upper bounds, in seconds, of the buckets for per-stage latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_PREFIX = "askfsdl"
+
+_latencies = {}  # stage -> Histogram
+_tokens = {}  # kind -> count
+_collectors = {}  # name -> function returning a dict of numbers
+_metrics_lock = threading.Lock()
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count, self.sum = 0, 0.0
+
+    def observe(self, value):
+        for ii, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[ii] += 1
+        self.count += 1
+        self.sum += value
+
+
+def observe(stage, seconds):
+    """Records the latency of one run of a stage."""
+    with _metrics_lock:
+        if stage not in _latencies:
+            _latencies[stage] = Histogram()
+        _latencies[stage].observe(seconds)
+
+
+def add_tokens(kind, count):
+    """Records tokens used, e.g. by the prompt or by the completion."""
+    with _metrics_lock:
+        _tokens[kind] = _tokens.get(kind, 0) + count
+
+
+def register_collector(name, collect):
+    """Adds a function, returning a dict of numbers, whose results are exported."""
+    _collectors[name] = collect
+
+
+@contextlib.contextmanager
+def span(stage, trace=None):
+    """Times the enclosed block as a stage, adding it to a trace if provided."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed)
+        if trace is not None:
+            trace.spans[stage] = trace.spans.get(stage, 0.0) + elapsed
+
+
+class Trace:
+    """Collects the stage timings and token counts for a single request.
+
+    Once the request is done, emit writes them out as a single JSON line.
+    """
+
+    def __init__(self, request_id=None, **fields):
+        self.request_id = request_id
+        self.fields = fields
+        self.spans, self.tokens = {}, {}
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+
+    def span(self, stage):
+        return span(stage, self)
+
+    def record(self, stage, seconds):
+        observe(stage, seconds)
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind, count):
+        add_tokens(kind, count)
+        self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def emit(self, **fields):
+        total = time.perf_counter() - self._start
+        observe("total", total)
+        record = {
+            "event": "qanda_trace",
+            "request_id": self.request_id,
+            "started_at": self.started_at,
+            "total_s": round(total, 6),
+            "spans_s": {stage: round(s, 6) for stage, s in self.spans.items()},
+            "tokens": self.tokens,
+            **self.fields,
+            **fields,
+        }
+        print(json.dumps(record, default=str), flush=True)
+        return record
+
+
+def llm_timer(trace):
+    """Creates a LangChain callback handler that times LLM calls into a trace.
+
+    Time from the handler's creation, just before the chain is called, to the start
+    of the LLM call is recorded as prompt assembly. Token counts come from the API's
+    usage report or, when streaming, from counting the prompt, with the counts of
+    static prompt prefixes cached, and the new tokens.
+    """
+    from langchain.callbacks.base import AsyncCallbackHandler
+
+    import prompts
+
+    class LLMTimer(AsyncCallbackHandler):
+        def __init__(self):
+            self.created = time.perf_counter()
+            self.llm_started, self.first_token = None, None
+            self.prompt_tokens, self.completion_tokens = 0, 0
+
+        async def on_chat_model_start(self, serialized, messages, **kwargs):
+            self.llm_started = time.perf_counter()
+            trace.record("prompt_assembly", self.llm_started - self.created)
+            self.prompt_tokens = sum(
+                prompts.count_prompt_tokens(message.content)
+                for batch in messages
+                for message in batch
+            )
+
+        async def on_llm_new_token(self, token: str, **kwargs) -> None:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+                trace.record("llm_first_token", self.first_token - self.llm_started)
+            self.completion_tokens += 1
+
+        async def on_llm_end(self, response, **kwargs) -> None:
+            trace.record("llm", time.perf_counter() - self.llm_started)
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt = usage.get("prompt_tokens", self.prompt_tokens)
+            completion = usage.get("completion_tokens", self.completion_tokens)
+            trace.add_tokens("prompt", prompt)
+            trace.add_tokens("completion", completion)
+
+    return LLMTimer()
+
+
+def render_metrics():
+    """Renders all metrics in the Prometheus text exposition format."""
+    prefix, lines = METRICS_PREFIX, []
+
+    with _metrics_lock:
+        lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+        for stage, histogram in sorted(_latencies.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                labels = f'stage="{stage}",le="{bound}"'
+                lines.append(f"{prefix}_stage_seconds_bucket{{{labels}}} {count}")
+            labels = f'stage="{stage}",le="+Inf"'
+            lines.append(f"{prefix}_stage_seconds_bucket{{{labels}}} {histogram.count}")
+            lines.append(
+                f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}'
+            )
+            lines.append(
+                f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}'
+            )
+
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for kind, count in sorted(_tokens.items()):
+            lines.append(f'{prefix}_tokens_total{{kind="{kind}"}} {count}')
+
+    for name, collect in sorted(_collectors.items()):
+        for key, value in sorted(collect().items()):
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE {prefix}_{name}_{key} gauge")
+                lines.append(f"{prefix}_{name}_{key} {value}")
+
+    return "\n".join(lines) + "\n"
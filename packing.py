@@ -0,0 +1,131 @@
+"""Packs retrieved chunks into the context of the prompt, within a token budget."""
+from utils import count_tokens
+
+CONFIG = {
+    "CANDIDATES": 20,  # chunks retrieved from the index before packing
+    "TOKEN_BUDGET": 1500,  # most tokens of chunks, as formatted, put in the prompt
+    "MAX_SIMILARITY_GAP": 0.15,  # chunks this much less similar than the best are cut
+    "MIN_SIMILARITY": 0.0,  # chunks less similar than this are cut
+    "MAX_CHUNKS_PER_SOURCE": 3,
+    "MIN_CHUNK_CHARS": 100,  # chunks shorter than this, once trimmed, are cut
+}
+
+# how each chunk is formatted in the prompt by the stuff chain
+DOCUMENT_TEMPLATE = "Content: {page_content}\nSource: {source}\n\n"
+
+
+def pack(sources_and_scores, budget=None, max_gap=None, min_similarity=None):
+    """Selects chunks for the prompt from ranked (Document, L2 distance) results.
+
+    Chunks are taken in rank order. Those much less similar to the query than the
+    best chunk, or less similar than min_similarity, are dropped, unless they have
+    no distance because they were found by exact terms rather than by vector.
+
+    Duplicated text is dropped, as is the overlap between chunks of the same
+    document, and each source contributes at most MAX_CHUNKS_PER_SOURCE chunks.
+    Chunks are then added while they fit in the token budget. The first chunk is
+    always included, truncated to the budget if need be.
+
+    Returns:
+        A tuple of the selected Documents and the number of tokens they take up.
+    """
+    budget = budget or CONFIG["TOKEN_BUDGET"]
+    max_gap = CONFIG["MAX_SIMILARITY_GAP"] if max_gap is None else max_gap
+    if min_similarity is None:
+        min_similarity = CONFIG["MIN_SIMILARITY"]
+
+    scores = [similarity(d) for _, d in sources_and_scores if d is not None]
+    best = max(scores, default=0.0)
+
+    selected, texts_by_document, seen, per_source, used = [], {}, set(), {}, 0
+    for document, distance in sources_and_scores:
+        if selected and distance is not None:
+            score = similarity(distance)
+            if score < min_similarity or best - score > max_gap:
+                continue
+
+        metadata = document.metadata
+        source = metadata.get("source")
+        if per_source.get(source, 0) >= CONFIG["MAX_CHUNKS_PER_SOURCE"]:
+            continue
+
+        text = document.page_content.strip()
+        if text in seen:
+            continue
+        seen.add(text)
+
+        key = metadata.get("sha256") or source
+        text = _trim_overlaps(text, texts_by_document.get(key, []))
+        if selected and len(text) < CONFIG["MIN_CHUNK_CHARS"]:
+            continue
+
+        tokens = count_tokens(
+            DOCUMENT_TEMPLATE.format(page_content=text, source=source)
+        )
+        if used + tokens > budget:
+            if selected:
+                continue  # a shorter chunk further down may still fit
+            text = _truncate(text, source, budget)
+            tokens = budget
+
+        selected.append(_with_text(document, text))
+        texts_by_document.setdefault(key, []).append(text)
+        per_source[source] = per_source.get(source, 0) + 1
+        used += tokens
+
+    return selected, used
+
+
+def similarity(distance):
+    """Converts a squared L2 distance between unit vectors to a cosine similarity."""
+    return 1.0 - distance / 2.0
+
+
+def _trim_overlaps(text, others, anchor=64):
+    """Removes text that overlaps the start or end of other chunks of a document.
+
+    Neighbouring chunks share up to CHUNK_OVERLAP tokens, so the end of one
+    chunk is found again at the start of the next.
+    """
+    for other in others:
+        head = _overlap(other, text, anchor)  # other comes just before text
+        if head:
+            text = text[head:].lstrip()
+        tail = _overlap(text, other, anchor)  # other comes just after text
+        if tail:
+            text = text[:-tail].rstrip()
+    return text
+
+
+def _overlap(first, second, anchor):
+    """Finds the length of the longest suffix of first that is a prefix of second."""
+    probe = first[-anchor:]
+    if len(probe) < anchor:
+        return 0
+    start = second.rfind(probe)
+    while start != -1:
+        length = start + anchor
+        if first.endswith(second[:length]):
+            return length
+        start = second.rfind(probe, 0, length - 1)
+    return 0
+
+
+def _truncate(text, source, budget):
+    """Shortens a chunk until, as formatted, it fits in the budget."""
+    while text:
+        formatted = DOCUMENT_TEMPLATE.format(page_content=text, source=source)
+        excess = count_tokens(formatted) - budget
+        if excess <= 0:
+            break
+        text = text[: -max(excess * 3, 16)]  # tokens are roughly four characters
+    return text
+
+
+def _with_text(document, text):
+    """Copies a document with new text, leaving the one in the docstore untouched."""
+    from langchain.docstore.document import Document
+
+    if text == document.page_content:
+        return document
+    return Document(page_content=text, metadata=document.metadata)
@@ -1,6 +1,26 @@
+import functools
+import os
+
 from langchain.prompts import PromptTemplate
+from langchain.prompts.base import StringPromptTemplate
+
+from utils import count_tokens
+
+# the prompt used for answers, unless another is requested
+PROMPT_VARIANT = os.environ.get("PROMPT_VARIANT", "main")
 
-template = """This is a question-answering system over a corpus of documents created by The Full Stack, which provides news, community, and courses for people building AI-powered products.
+# shown in the Gradio UI, and used as the default benchmark query set
+EXAMPLE_QUESTIONS = [
+    "What is zero-shot chain-of-thought prompting?",
+    "Would you rather fight 100 LLaMA-sized GPT-4s or 1 GPT-4-sized LLaMA?",
+    "What are the differences in capabilities between GPT-3 davinci and GPT-3.5 code-davinci-002?",  # noqa: E501
+    "What is PyTorch? How can I decide whether to choose it over TensorFlow?",
+    "Is it cheaper to run experiments on cheap GPUs or expensive GPUs?",
+    "How do I recruit an ML team?",
+    "What is the best way to learn about ML?",
+]
+
+main_prefix = """This is a question-answering system over a corpus of documents created by The Full Stack, which provides news, community, and courses for people building AI-powered products.
 The documents include notes and transcripts of lectures from the Full Stack Deep Learning course, the Full Stack Large Language Models Bootcamp and select papers from the literature, as well as other sources.
 
 Given chunks from multiple documents and a question, create an answer to the question that references those documents as "SOURCES".
@@ -70,13 +90,99 @@ QUESTION: what can you do
 =========
 FINAL ANSWER: This question-answering system uses content from The Full Stack's corpus to provided sourced answers to questions about building AI-powered products.
 
-QUESTION: {question}
+"""  # noqa: E501
+
+# the same instructions, more tersely, with a single, shorter example
+compact_prefix = """This is a question-answering system over documents from The Full Stack: notes and transcripts of lectures from the Full Stack Deep Learning course and the Full Stack Large Language Models Bootcamp, select papers, and other sources.
+
+Given chunks from documents and a question, answer the question and reference the documents used as "SOURCES".
+
+- If asked about the system's capabilities, say that it can answer questions about building AI-powered products across the stack, about large language models, and about the Full Stack's courses and materials. No sources are needed.
+- If the answer cannot be determined from the chunks or these instructions, return "No relevant sources found".
+- Chunks may be truncated and are not guaranteed to be relevant.
+
+QUESTION: What is zero-shot chain-of-thought prompting?
+=========
+Content: We propose Zero-shot-CoT, a zero-shot template-based prompting for chain of thought reasoning. It differs from the original chain of thought prompting [Wei et al., 2022] as it does not require step-by-step few-shot examples. The core idea of our method is simple: add Let’s think step by step, or a similar text, to extract step-by-step reasoning.
+Source: https://arxiv.org/pdf/2205.11916.pdf
+
+Content: Chain-of-thought prompting. Our proposed approach is to augment each exemplar in few-shot prompting with a chain of thought for an associated answer.
+Source: https://arxiv.org/pdf/2201.11903.pdf
+=========
+FINAL ANSWER: Zero-shot chain-of-thought prompting is a task-agnostic prompting technique that elicits step-by-step reasoning without few-shot examples, by adding a prompt such as "Let's think step by step" before answering the question.
+SOURCES: https://arxiv.org/pdf/2205.11916.pdf
+
+"""  # noqa: E501
+
+suffix = PromptTemplate(
+    template="""QUESTION: {question}
 =========
 {sources}
 =========
-FINAL ANSWER:"""  # noqa: E501
+FINAL ANSWER:""",
+    input_variables=["sources", "question"],
+)
+
+
+class PrefixedPromptTemplate(StringPromptTemplate):
+    """A prompt made of a static prefix and a suffix template.
+
+    Only the suffix is formatted per request. The prefix ends on a line break, where
+    tiktoken always splits, so its tokens can be counted once and reused.
+    """
+
+    prefix: str
+    suffix: PromptTemplate
+
+    def format(self, **kwargs) -> str:
+        kwargs = self._merge_partial_and_user_variables(**kwargs)
+        return self.prefix + self.suffix.format(**kwargs)
+
+    def count_tokens(self, text):
+        """Counts the tokens in a prompt, using the cached count for the prefix."""
+        if text.startswith(self.prefix):
+            return count_prefix_tokens(self.prefix) + count_tokens(
+                text[len(self.prefix) :]
+            )
+        return count_tokens(text)
+
+    @property
+    def _prompt_type(self) -> str:
+        return "prefixed"
+
+
+main = PrefixedPromptTemplate(
+    prefix=main_prefix, suffix=suffix, input_variables=["sources", "question"]
+)
+compact = PrefixedPromptTemplate(
+    prefix=compact_prefix, suffix=suffix, input_variables=["sources", "question"]
+)
+
+VARIANTS = {"main": main, "compact": compact}
+
+
+def get_prompt(variant=None):
+    """Returns a prompt variant by name, by default PROMPT_VARIANT."""
+    variant = variant or PROMPT_VARIANT
+    if variant not in VARIANTS:
+        raise ValueError(
+            f"unknown prompt variant {variant}, try one of {list(VARIANTS)}"
+        )
+    return VARIANTS[variant]
+
+
+def count_prompt_tokens(text):
+    """Counts the tokens in a formatted prompt, reusing counts of static prefixes."""
+    for prompt in VARIANTS.values():
+        if text.startswith(prompt.prefix):
+            return prompt.count_tokens(text)
+    return count_tokens(text)
+
+
+@functools.lru_cache(maxsize=None)
+def count_prefix_tokens(prefix):
+    return count_tokens(prefix)
 
-main = PromptTemplate(template=template, input_variables=["sources", "question"])
 
 per_source = PromptTemplate(
     template="Content: {page_content}\nSource: {source}",
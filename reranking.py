@@ -0,0 +1,84 @@
+"""Reranks retrieved chunks on CPU, before they are packed into the prompt."""
+import functools
+import os
+
+CONFIG = {
+    "ENABLED": os.environ.get("RERANK", "false").lower() in ("1", "true", "yes"),
+    "CANDIDATES": 30,  # chunks retrieved from the index for reranking
+    "TOP_N": 8,  # best reranked chunks passed on for packing
+    # "hybrid", for a blend of vector similarity and BM25, or a cross-encoder model
+    "MODEL": os.environ.get("RERANK_MODEL", "hybrid"),
+    "SEMANTIC_WEIGHT": 0.5,  # weight of vector similarity in the hybrid score
+    "BATCH_SIZE": 32,  # query-chunk pairs scored at once by a cross-encoder
+}
+
+
+def rerank(query, sources_and_scores, sparse_index=None, top_n=None, model=None):
+    """Reorders (Document, L2 distance) results by a finer relevance score.
+
+    By default, chunks are scored by a blend of their vector similarity to the
+    query and their BM25 score, both scaled to [0, 1] over the candidates. Chunks
+    found only by their terms have no distance, so they are given the similarity
+    of the least similar chunk found by vector search, which bounds theirs.
+
+    If model names a cross-encoder, like "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    the query and each chunk are instead scored together by that model, in
+    batches, which is slower but more accurate. It needs sentence-transformers.
+
+    Returns:
+        The top_n (Document, L2 distance) pairs, best first.
+    """
+    top_n = top_n or CONFIG["TOP_N"]
+    model = model or CONFIG["MODEL"]
+    if len(sources_and_scores) <= 1:
+        return list(sources_and_scores)
+
+    texts = [document.page_content for document, _ in sources_and_scores]
+    if model == "hybrid":
+        scores = hybrid_scores(
+            query, texts, [d for _, d in sources_and_scores], sparse_index
+        )
+    else:
+        scores = get_cross_encoder(model).predict(
+            [(query, text) for text in texts], batch_size=CONFIG["BATCH_SIZE"]
+        )
+
+    order = sorted(range(len(texts)), key=lambda ii: scores[ii], reverse=True)
+    return [sources_and_scores[ii] for ii in order[:top_n]]
+
+
+def hybrid_scores(query, texts, distances, sparse_index=None):
+    """Blends vector similarities and BM25 scores for each text, in [0, 1]."""
+    import numpy as np
+
+    import packing
+    import sparse
+
+    similarities = [packing.similarity(d) for d in distances if d is not None]
+    floor = min(similarities, default=0.0)
+    semantic = np.array(
+        [packing.similarity(d) if d is not None else floor for d in distances]
+    )
+
+    if sparse_index is None:  # score with idf from the candidates alone
+        sparse_index = sparse.SparseIndex.build(enumerate(texts))
+    lexical = sparse_index.score_texts(query, texts)
+
+    weight = CONFIG["SEMANTIC_WEIGHT"]
+    return weight * _scale(semantic) + (1 - weight) * _scale(lexical)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cross_encoder(model):
+    """Loads a cross-encoder once per container."""
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(model, device="cpu")
+
+
+def _scale(scores):
+    """Scales scores to [0, 1], or to all zeros if they are all the same."""
+    low, high = scores.min(), scores.max()
+    if high - low <= 0:
+        return scores * 0.0
+    return (scores - low) / (high - low)
@@ -0,0 +1,193 @@
+"""A compact BM25 inverted index, for exact-term retrieval alongside vector search."""
+import re
+from array import array
+
+# BM25 parameters: term frequency saturation and document length normalization
+K1, B = 1.2, 0.75
+# common words, which would have long postings lists and contribute little to scores
+STOPWORDS = frozenset(
+    """a an and are as at be but by can do does for from how i if in into is it its
+    me my of on or so than that the their then there these this to was we what when
+    where which who why will with you your""".split()
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-_][a-z0-9]+)*")
+
+
+def tokenize(text):
+    """Splits text into lowercase terms, for both documents and queries.
+
+    Dotted and hyphenated terms, like arXiv IDs or "chain-of-thought", are kept
+    whole and also split into their parts, so either form of a query matches.
+    """
+    terms = []
+    for term in TOKEN_PATTERN.findall(text.lower()):
+        if term not in STOPWORDS:
+            terms.append(term)
+        if not term.isalnum():
+            terms.extend(
+                part for part in re.split(r"[.\-_]", term) if part not in STOPWORDS
+            )
+    return terms
+
+
+class SparseIndex:
+    """An inverted index over chunks, scored with BM25 and stored in flat arrays.
+
+    Postings are kept in compressed sparse row form: the postings of term t are
+    rows[indptr[t]:indptr[t + 1]], with term frequencies in tfs. Rows are mapped to
+    the FAISS ids of chunks by ids, so results can be fused with vector search.
+    """
+
+    def __init__(self, terms, indptr, rows, tfs, lengths, ids):
+        import numpy as np
+
+        self.terms = terms
+        self.vocabulary = {term: ii for ii, term in enumerate(terms)}
+        self.indptr, self.rows, self.tfs = indptr, rows, tfs
+        self.lengths, self.ids = lengths, ids
+
+        n_docs = max(len(ids), 1)
+        df = np.diff(indptr).astype("float32")
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+        avg_length = float(lengths.mean()) if len(lengths) else 1.0
+        self.norms = (K1 * (1 - B + B * lengths / max(avg_length, 1.0))).astype(
+            "float32"
+        )
+
+    @classmethod
+    def build(cls, chunks):
+        """Builds an index from (FAISS id, text) pairs."""
+        import collections
+
+        import numpy as np
+
+        vocabulary = {}
+        term_ids, rows, tfs = array("i"), array("i"), array("f")
+        ids, lengths = array("q"), array("f")
+        for row, (faiss_id, text) in enumerate(chunks):
+            terms = tokenize(text)
+            for term, tf in collections.Counter(terms).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                rows.append(row)
+                tfs.append(tf)
+            ids.append(faiss_id)
+            lengths.append(len(terms))
+
+        term_ids = np.frombuffer(term_ids, dtype="int32")
+        order = np.argsort(term_ids, kind="stable")  # group postings by term
+        indptr = np.zeros(len(vocabulary) + 1, dtype="int64")
+        np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)), out=indptr[1:])
+
+        return cls(
+            list(vocabulary),
+            indptr,
+            np.frombuffer(rows, dtype="int32")[order],
+            np.frombuffer(tfs, dtype="float32")[order],
+            np.frombuffer(lengths, dtype="float32").copy(),
+            np.frombuffer(ids, dtype="int64").copy(),
+        )
+
+    def search(self, query, k=20, mask=None):
+        """Finds the k chunks that best match the query's terms.
+
+        Arguments:
+            mask: A boolean array over rows. If provided, only chunks in rows where
+                it is True are returned.
+
+        Returns:
+            A list of (FAISS id, BM25 score) pairs, best first.
+        """
+        import numpy as np
+
+        term_ids = {self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary}
+        if not term_ids:
+            return []
+
+        scores = np.zeros(len(self.ids), dtype="float32")
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            rows, tfs = self.rows[start:end], self.tfs[start:end]
+            scores[rows] += (
+                self.idf[term_id] * tfs * (K1 + 1) / (tfs + self.norms[rows])
+            )
+
+        if mask is not None:
+            scores[~mask] = 0.0
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(self.ids[row]), float(scores[row])) for row in top]
+
+    def score_texts(self, query, texts):
+        """Scores texts against a query with BM25, using this index's statistics.
+
+        The texts need not be in the index, so results from any search can be
+        scored on the same scale.
+
+        Returns:
+            An array of BM25 scores, one for each text.
+        """
+        import collections
+
+        import numpy as np
+
+        term_ids = {self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary}
+        avg_length = float(self.lengths.mean()) if len(self.lengths) else 1.0
+
+        scores = np.zeros(len(texts), dtype="float32")
+        for ii, text in enumerate(texts):
+            terms = tokenize(text)
+            counts = collections.Counter(terms)
+            norm = K1 * (1 - B + B * len(terms) / max(avg_length, 1.0))
+            for term_id in term_ids:
+                tf = counts.get(self.terms[term_id], 0)
+                if tf:
+                    scores[ii] += self.idf[term_id] * tf * (K1 + 1) / (tf + norm)
+
+        return scores
+
+    def save(self, path):
+        """Saves the index as uncompressed arrays in a single .npz file."""
+        import numpy as np
+
+        np.savez(
+            path,
+            terms=np.frombuffer("\n".join(self.terms).encode("utf-8"), dtype="uint8"),
+            indptr=self.indptr,
+            rows=self.rows,
+            tfs=self.tfs,
+            lengths=self.lengths,
+            ids=self.ids,
+        )
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        with np.load(path) as arrays:
+            terms = arrays["terms"].tobytes().decode("utf-8")
+            return cls(
+                terms.split("\n") if terms else [],
+                arrays["indptr"],
+                arrays["rows"],
+                arrays["tfs"],
+                arrays["lengths"],
+                arrays["ids"],
+            )
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuses rankings of ids into one, scoring each id by the sum of 1 / (k + rank).
+
+    Returns:
+        A list of (id, fused score) pairs, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
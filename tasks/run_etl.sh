@@ -3,6 +3,7 @@ set -euo pipefail
 
 # set empty defaults
 drop=false
+refresh=false
 db=""
 collection=""
 
@@ -13,6 +14,10 @@ while (( "$#" )); do
       drop=true
       shift
       ;;
+    --refresh)
+      refresh=true
+      shift
+      ;;
     --db)
       if [ -n "$2" ] && [ "${2:0:1}" != "-" ]; then
         db=$2
@@ -45,16 +50,22 @@ collection=${collection:-$MONGODB_COLLECTION}
 set --
 source tasks/pretty_log.sh
 
-if [ $drop ]; then
+# sources unchanged since the last run are skipped, unless we --refresh them all
+refresh_flag=""
+if [ "$refresh" = true ]; then
+  refresh_flag="--refresh"
+fi
+
+if [ "$drop" = true ]; then
   pretty_log "Dropping collection $collection in $db"
   modal run app.py::drop_docs --db "$db" --collection "$collection"
 fi
 
 pretty_log "Extracting video transcripts"
-modal run etl/videos.py --json-path data/videos.json --db "$db" --collection "$collection"
+modal run etl/videos.py --json-path data/videos.json --db "$db" --collection "$collection" $refresh_flag
 
 pretty_log "Extracting Markdown lectures"
-modal run etl/markdown.py --json-path data/lectures-2022.json --db "$db" --collection "$collection"
+modal run etl/markdown.py --json-path data/lectures-2022.json --db "$db" --collection "$collection" $refresh_flag
 
 pretty_log "Extracting paper PDFs"
-modal run etl/pdfs.py --json-path data/llm-papers.json --db "$db" --collection "$collection"
+modal run etl/pdfs.py --json-path data/llm-papers.json --db "$db" --collection "$collection" $refresh_flag
@@ -1,9 +1,22 @@
 """Some simple utilities for the project."""
+import functools
 
 
 def pretty_log(*args):
     print(f"{START}🥞:", *args, f"{END}")
 
 
+def count_tokens(text, model="gpt-4"):
+    """Counts the tokens in a text for an OpenAI model."""
+    return len(_get_encoding(model).encode(text, disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
+
+
 # Terminal codes for pretty-printing.
 START, END = "\033[1;38;5;214m", "\033[0m"
@@ -1,42 +1,1211 @@
 """Utilities for creating and using vector indexes."""
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
 from pathlib import Path
 
 from utils import pretty_log
 
-INDEX_NAME = "openai-ada-fsdl"
+# the index to build and serve, which also determines the embedding model
+INDEX_NAME = os.environ.get("VECTOR_INDEX_NAME", "openai-ada-fsdl")
+EMBEDDING_MODELS = {
+    "openai-ada-fsdl": "text-embedding-ada-002",
+    "hashing-fsdl": "hashing-ngram-1024",  # runs locally, no API needed
+}
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
 VECTOR_DIR = Path("/vectors")
+EMBEDDING_CACHE_DIR = VECTOR_DIR / "embedding-cache"
+VERSIONS_DIR = VECTOR_DIR / "versions"
 
+# size of and overlap between chunks of documents, in tokens
+CHUNK_SIZE, CHUNK_OVERLAP = 500, 100
+# number of documents handed to each splitting process at a time
+SPLIT_WINDOW_PER_PROCESS = 32
+# number of chunks embedded and added to an index at a time while building it
+EMBEDDING_BATCH_SIZE = 1024
+# how often, in seconds, index builds report their progress
+PROGRESS_INTERVAL = 10.0
 
-def connect_to_vector_index(index_name, embedding_engine):
-    """Adds the texts and metadatas to the vector index."""
+# types of FAISS index, from exact to approximate, and their default parameters
+INDEX_TYPES = {
+    "flat": {},  # exact, brute-force search
+    "ivf-flat": {"nlist": 1024, "nprobe": 16},
+    "ivf-pq": {"nlist": 1024, "nprobe": 16, "m": 64, "nbits": 8},
+    "hnsw": {"M": 32, "efConstruction": 80, "efSearch": 64},
+}
+DEFAULT_INDEX_TYPE = "flat"
+# index types that support removing vectors, and so incremental updates
+UPDATABLE_INDEX_TYPES = {"flat", "ivf-flat", "ivf-pq"}
+# most vectors held back from the stream to train an index that needs training
+TRAINING_SAMPLE_SIZE = 65_536
+
+# how often, in seconds, a resident index checks the disk for a newer version
+RELOAD_CHECK_INTERVAL = 30.0
+
+# container-lifecycle state: loaded once, then reused across requests
+_resident = {}
+_resident_lock = threading.Lock()
+
+
+def connect_to_vector_index(index_name, embedding_engine, version=None, mmap=False):
+    """Loads a version of the vector index, by default the current one.
+
+    With mmap set, the vectors and the chunk store are memory-mapped rather than
+    read into memory, so loading is quick and only the pages used by searches are
+    read. Memory-mapped indexes are read-only, so they are for serving, not updates.
+    """
     from langchain.vectorstores import FAISS
 
-    vector_index = FAISS.load_local(VECTOR_DIR, embedding_engine, index_name)
+    import chunkstore
+
+    version = version or get_index_version(index_name)
+    folder_path = get_index_dir(index_name, version)
+    chunks_path = Path(folder_path) / f"{index_name}.chunks"
+
+    if not chunkstore.exists(chunks_path):  # saved with a pickled docstore
+        vector_index = FAISS.load_local(folder_path, embedding_engine, index_name)
+        vector_index.manifest = _read_manifest(folder_path, index_name, vector_index)
+    else:
+        manifest = json.loads((Path(folder_path) / f"{index_name}.json").read_text())
+        index = _read_faiss_index(
+            Path(folder_path) / f"{index_name}.faiss", manifest["index_type"], mmap
+        )
+        docstore = chunkstore.ChunkStore(chunks_path)
+        if mmap:
+            index_to_docstore_id = docstore.index_to_docstore_id
+        else:
+            from langchain.docstore.in_memory import InMemoryDocstore
+
+            documents, index_to_docstore_id = {}, {}
+            for faiss_id, docstore_id, document in docstore.items():
+                documents[docstore_id] = document
+                index_to_docstore_id[faiss_id] = docstore_id
+            docstore = InMemoryDocstore(documents)
+        vector_index = FAISS(
+            embedding_engine.embed_query, index, docstore, index_to_docstore_id
+        )
+        vector_index.manifest = manifest
+
+    vector_index.embedding_engine = embedding_engine  # for async query embedding
+    _apply_search_defaults(vector_index)
+    vector_index.sparse_index = _load_sparse_index(folder_path, index_name)
+    vector_index.filter_index = _load_filter_index(folder_path, index_name)
 
     return vector_index
 
 
-def get_embedding_engine(model="text-embedding-ada-002", **kwargs):
-    """Retrieves the embedding engine."""
-    from langchain.embeddings import OpenAIEmbeddings
+def get_resident_vector_index(index_name=INDEX_NAME, trace=None, **embedding_kwargs):
+    """Returns a vector index that stays loaded for the lifetime of the container.
+
+    The index is memory-mapped from disk on first use. Afterwards, the files on disk are
+    checked at most once every RELOAD_CHECK_INTERVAL seconds and the index is
+    only reloaded if they have changed. Loads are timed into the monitoring.Trace
+    of the request that triggers them, if one is provided.
+    """
+    import monitoring
+
+    now = time.monotonic()
+    entry = _resident.get(index_name)
+    if entry is not None and now - entry["checked_at"] < RELOAD_CHECK_INTERVAL:
+        return entry["index"]
+
+    with _resident_lock:
+        entry = _resident.get(index_name)
+        version = get_index_version(index_name)
+        if entry is None or entry["version"] != version:
+            if entry is None:
+                pretty_log(f"loading vector index {index_name}")
+                with monitoring.span("embedding_engine_init", trace):
+                    embedding_engine = get_embedding_engine(
+                        get_embedding_model(index_name), **embedding_kwargs
+                    )
+            else:
+                pretty_log(f"vector index {index_name} changed on disk, reloading")
+                embedding_engine = entry["embedding_engine"]
+            with monitoring.span("index_connect", trace):
+                vector_index = connect_to_vector_index(
+                    index_name, embedding_engine, version=version, mmap=True
+                )
+            entry = {
+                "index": vector_index,
+                "embedding_engine": embedding_engine,
+                "version": version,
+                "checked_at": now,
+            }
+            _resident[index_name] = entry
+            pretty_log(f"loaded {vector_index.index.ntotal} vectors from {index_name}")
+        entry["checked_at"] = now
+
+    return entry["index"]
+
+
+def get_resident_version(index_name=INDEX_NAME):
+    """Returns the on-disk version of the resident index, or None if not loaded."""
+    entry = _resident.get(index_name)
+
+    return entry["version"] if entry is not None else None
+
+
+def get_index_version(index_name):
+    """Returns a token that changes whenever the index on disk changes.
+
+    Versioned indexes, written by save_vector_index, are identified by the name
+    stored in their pointer file. Indexes in the older, unversioned layout are
+    identified by the modification times and sizes of their files.
+    """
+    pointer = _pointer_path(index_name)
+    if pointer.exists():
+        return pointer.read_text().strip()
+
+    stats = [(file.name, file.stat()) for file in VECTOR_DIR.glob(f"{index_name}.*")]
+
+    return tuple(sorted((name, st.st_mtime_ns, st.st_size) for name, st in stats))
+
+
+def get_index_dir(index_name, version):
+    """Returns the folder that holds the files for a version of the index."""
+    if isinstance(version, str):
+        return VERSIONS_DIR / index_name / version
+    else:  # the older, unversioned layout
+        return VECTOR_DIR
+
+
+def save_vector_index(vector_index, index_name, keep=2):
+    """Saves the vector index as a new version and atomically makes it current.
+
+    The index is written to a fresh version folder and then the pointer file is
+    replaced, so readers only ever see a complete index. The most recent `keep`
+    versions are retained so that readers still loading an old one can finish.
+
+    Vectors are written as a FAISS index and chunks to a chunkstore, rather than a
+    pickle, so that both can be memory-mapped by connect_to_vector_index.
+    """
+    import datetime
+    import os
+    import shutil
+
+    import faiss
+
+    import chunkstore
+
+    version = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    version_dir = get_index_dir(index_name, version)
+    version_dir.mkdir(parents=True)
+    faiss.write_index(vector_index.index, str(version_dir / f"{index_name}.faiss"))
+    chunkstore.write(
+        version_dir / f"{index_name}.chunks",
+        (
+            (faiss_id, docstore_id, vector_index.docstore.search(docstore_id))
+            for faiss_id, docstore_id in vector_index.index_to_docstore_id.items()
+        ),
+    )
+    vector_index.sparse_index = build_sparse_index(vector_index)
+    vector_index.sparse_index.save(version_dir / f"{index_name}.bm25.npz")
+    vector_index.filter_index = build_filter_index(vector_index)
+    vector_index.filter_index.save(version_dir / f"{index_name}.filters.npz")
+    manifest = dict(vector_index.manifest, ntotal=vector_index.index.ntotal)
+    (version_dir / f"{index_name}.json").write_text(json.dumps(manifest, indent=2))
+
+    pointer = _pointer_path(index_name)
+    tmp_pointer = pointer.with_name(f"{pointer.name}.{os.getpid()}.tmp")
+    tmp_pointer.write_text(version)
+    os.replace(tmp_pointer, pointer)
+    pretty_log(f"vector index {index_name} version {version} is now current")
+
+    for suffix in (".faiss", ".pkl"):  # clean up the older, unversioned layout
+        (VECTOR_DIR / f"{index_name}{suffix}").unlink(missing_ok=True)
+    old_versions = sorted((VERSIONS_DIR / index_name).iterdir())[:-keep]
+    for old_version in old_versions:
+        if old_version.name == version:
+            continue
+        shutil.rmtree(old_version, ignore_errors=True)
+
+    return version
+
+
+def build_sparse_index(vector_index):
+    """Builds a BM25 index over the texts of all the chunks in a vector index.
+
+    It is rebuilt from the docstore whenever the index is saved, so that it always
+    matches the vectors, including after incremental updates.
+    """
+    import sparse
+
+    start = time.monotonic()
+    sparse_index = sparse.SparseIndex.build(
+        (faiss_id, vector_index.docstore.search(docstore_id).page_content)
+        for faiss_id, docstore_id in vector_index.index_to_docstore_id.items()
+    )
+    pretty_log(
+        f"built sparse index of {len(sparse_index.terms)} terms over"
+        f" {len(sparse_index.ids)} chunks in {time.monotonic() - start:.1f}s"
+    )
+
+    return sparse_index
+
+
+def build_filter_index(vector_index):
+    """Builds bitsets over the chunks of a vector index for filtering searches.
+
+    Rows are in the same order as in build_sparse_index, so the two line up.
+    """
+    import filters
+
+    return filters.FilterIndex.build(
+        (faiss_id, vector_index.docstore.search(docstore_id).metadata)
+        for faiss_id, docstore_id in vector_index.index_to_docstore_id.items()
+    )
+
+
+def _load_filter_index(folder_path, index_name):
+    import filters
+
+    path = Path(folder_path) / f"{index_name}.filters.npz"
+    return filters.FilterIndex.load(path) if path.exists() else None
+
+
+def _load_sparse_index(folder_path, index_name):
+    import sparse
+
+    path = Path(folder_path) / f"{index_name}.bm25.npz"
+    return sparse.SparseIndex.load(path) if path.exists() else None
+
+
+def _read_faiss_index(path, index_type, mmap=False):
+    """Reads a FAISS index, memory-mapping its vectors if mmap is set.
+
+    The inverted lists of IVF indexes are mapped with IO_FLAG_MMAP. The vectors
+    of flat and HNSW indexes are mapped with IO_FLAG_MMAP_IFC, in newer FAISS
+    versions, and otherwise read into memory.
+    """
+    import faiss
+
+    if not mmap:
+        return faiss.read_index(str(path))
+
+    if index_type.startswith("ivf-"):
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    else:
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(str(path), flags)
+    except RuntimeError as e:
+        pretty_log(f"could not memory-map {path.name}, reading it instead: {e}")
+        return faiss.read_index(str(path))
+
+
+def _pointer_path(index_name):
+    return VECTOR_DIR / f"{index_name}.current"
+
+
+def _read_manifest(folder_path, index_name, vector_index):
+    """Reads the manifest describing an index, or infers one for older indexes."""
+    import faiss
+
+    path = Path(folder_path) / f"{index_name}.json"
+    if path.exists():
+        return json.loads(path.read_text())
+
+    is_flat = isinstance(vector_index.index, faiss.IndexIDMap)
+    return {"index_type": "flat" if is_flat else "legacy-flat", "params": {}}
+
 
-    embedding_engine = OpenAIEmbeddings(model=model, **kwargs)
+def _apply_search_defaults(vector_index):
+    """Sets the index's default search parameters from its manifest."""
+    import faiss
+
+    index_type = vector_index.manifest["index_type"]
+    params = vector_index.manifest["params"]
+    if index_type.startswith("ivf-"):
+        faiss.extract_index_ivf(vector_index.index).nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        faiss.downcast_index(vector_index.index.index).hnsw.efSearch = params[
+            "efSearch"
+        ]
+
+
+def get_embedding_model(index_name=INDEX_NAME):
+    """Looks up the embedding model used by a vector index."""
+    return EMBEDDING_MODELS.get(index_name, DEFAULT_EMBEDDING_MODEL)
+
+
+def get_embedding_engine(model=None, cache=True, concurrent=False, **kwargs):
+    """Retrieves the embedding engine.
+
+    Engines embed texts via embed_documents and embed_query. By default, the
+    model is the one used by the INDEX_NAME index. Models named "hashing-*" run
+    locally with HashingEmbeddings. Other models are served by OpenAI, and
+    kwargs are passed on to their engine.
+
+    With concurrent set, texts are embedded by an embedder.AsyncEmbedder, which
+    keeps many rate-limited requests in flight and doesn't block the event loop
+    when called via aembed_documents and aembed_query.
+
+    Unless cache is False, OpenAI engines are wrapped in a CachedEmbeddings so
+    that texts that have been embedded before are read from EMBEDDING_CACHE_DIR.
+    """
+    model = model or get_embedding_model()
+
+    if model.startswith("hashing-"):
+        return HashingEmbeddings.from_model_name(model)
+
+    if concurrent:
+        import atexit
+
+        import embedder
+
+        embedding_engine = embedder.AsyncEmbedder(model=model, **kwargs)
+        atexit.register(embedding_engine.close)
+    else:
+        from langchain.embeddings import OpenAIEmbeddings
+
+        embedding_engine = OpenAIEmbeddings(model=model, **kwargs)
+
+    if cache:
+        embedding_engine = CachedEmbeddings(embedding_engine, model)
 
     return embedding_engine
 
 
-def create_vector_index(index_name, embedding_engine, documents, metadatas):
-    """Creates a vector index that offers similarity search."""
-    from langchain import FAISS
+class HashingEmbeddings:
+    """Embeds texts locally by hashing their words and character n-grams.
+
+    Word unigrams and bigrams and character n-grams are hashed into a fixed number
+    of signed buckets, weighted sublinearly, and L2-normalized, all in NumPy.
+    Needs no model weights or network access, so it suits offline builds and
+    low-latency queries, at some cost in recall relative to learned embeddings.
+    """
+
+    def __init__(self, dimension=1024, ngram_range=(3, 5)):
+        self.model = f"hashing-ngram-{dimension}"
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+
+    @classmethod
+    def from_model_name(cls, model):
+        """Creates an engine from a name like "hashing-ngram-1024"."""
+        return cls(dimension=int(model.rsplit("-", 1)[-1]))
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts."""
+        return self.embed(texts).tolist()
+
+    def embed_query(self, text):
+        """Embeds a single text."""
+        return self.embed([text])[0].tolist()
+
+    async def aembed_documents(self, texts):
+        """Embeds a list of texts. Runs inline, since hashing is fast and local."""
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text):
+        """Embeds a single text. Runs inline, since hashing is fast and local."""
+        return self.embed_query(text)
+
+    def embed(self, texts):
+        """Embeds a list of texts into a float32 array, one row per text.
+
+        Each distinct word or bigram in the batch is hashed once, as are the
+        n-grams of each distinct word, which are reused across batches. Features
+        are then expanded, bucketed, signed and summed into rows in bulk.
+        """
+        import re
+
+        import numpy as np
+
+        word_ids, bigram_hashes = {}, {}  # distinct features in the batch
+        word_rows, words, bigram_rows, bigrams = [], [], [], []
+        for row, text in enumerate(texts):
+            tokens = re.findall(r"\w+", text.lower())
+            words += [word_ids.setdefault(token, len(word_ids)) for token in tokens]
+            word_rows += [row] * len(tokens)
+            for a, b in zip(tokens, tokens[1:]):
+                bigram = f"{a} {b}"
+                if bigram not in bigram_hashes:
+                    bigram_hashes[bigram] = _crc32(bigram)
+                bigrams.append(bigram_hashes[bigram])
+            bigram_rows += [row] * max(len(tokens) - 1, 0)
+
+        embeddings = np.zeros((len(texts), self.dimension), dtype="float32")
+        if word_ids:
+            n_words = len(word_ids)
+            words = np.array(words, dtype="int64")
+            word_rows = np.array(word_rows, dtype="int64")
+            word_hashes = np.fromiter(map(_crc32, word_ids), "int64", n_words)
+
+            # n-grams are counted per distinct word in each row, then expanded
+            cells, counts = np.unique(word_rows * n_words + words, return_counts=True)
+            cell_words = cells % n_words
+            ngrams = [_ngram_hashes(word, *self.ngram_range) for word in word_ids]
+            lengths = np.fromiter(map(len, ngrams), "int64", n_words)
+            cell_lengths = lengths[cell_words]
+            # the positions of each cell's word's n-grams, in all words' n-grams
+            shifts = np.cumsum(lengths)[cell_words] - np.cumsum(cell_lengths)
+            positions = np.repeat(shifts, cell_lengths) + np.arange(cell_lengths.sum())
+
+            rows = np.concatenate(
+                [
+                    word_rows,
+                    np.array(bigram_rows, dtype="int64"),
+                    np.repeat(cells // n_words, cell_lengths),
+                ]
+            )
+            hashes = np.concatenate(
+                [
+                    word_hashes[words],
+                    np.array(bigrams, dtype="int64"),
+                    np.concatenate(ngrams)[positions],
+                ]
+            )
+            weights = np.concatenate(
+                [np.ones(len(words) + len(bigrams)), np.repeat(counts, cell_lengths)]
+            )
+            weights = np.where(hashes & 1 << 31, -weights, weights)
+            embeddings += np.bincount(
+                rows * self.dimension + hashes % self.dimension,
+                weights=weights,
+                minlength=embeddings.size,
+            ).reshape(embeddings.shape)
+
+        embeddings = np.sign(embeddings) * np.log1p(np.abs(embeddings))
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+@functools.lru_cache(maxsize=2**16)
+def _ngram_hashes(word, low, high):
+    """Hashes the character n-grams of a word, padded with spaces, once per word."""
+    import numpy as np
+
+    padded = f" {word} "
+    ngrams = [
+        padded[ii : ii + n]
+        for n in range(low, high + 1)
+        for ii in range(len(padded) - n + 1)
+    ]
+    return np.fromiter(map(_crc32, ngrams), "int64", len(ngrams))
+
+
+def _crc32(feature):
+    import zlib
+
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+class CachedEmbeddings:
+    """Wraps an embedding engine with a content-addressed cache of embeddings.
+
+    Embeddings are keyed by the model name and the sha256 of the text, the same
+    hash that etl.shared.enrich_metadata stores for documents. Each batch of newly
+    embedded texts is stored on disk as one shard: a .npy file of float32
+    embeddings and a .keys file of their hashes, one per line. So a build touches
+    a few files per batch, rather than one per chunk, which matters on the
+    network file system.
+
+    The keys of all shards are read into memory when texts are missing from it,
+    and embeddings are read in bulk from memory-mapped shards. Recently-used
+    embeddings are also kept in memory. Query embeddings are only kept in memory,
+    so that serving never lists or writes shards.
+    """
+
+    def __init__(self, embedding_engine, model, cache_dir=None, memory_size=4096):
+        import collections
+
+        self.embedding_engine = embedding_engine
+        self.model = model
+        self.cache_dir = Path(cache_dir or EMBEDDING_CACHE_DIR) / _slugify(model)
+        self.memory_size = memory_size
+        self.hits, self.misses = 0, 0
+
+        self._memory = collections.OrderedDict()
+        self._locations = {}  # key -> (shard name, row)
+        self._shards = {}  # shard name -> array of embeddings, memory-mapped
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        """Embeds a list of texts, only sending uncached texts to the engine."""
+        keys, embeddings, missing = self._lookup(texts)
+        if missing:
+            new_embeddings = self.embedding_engine.embed_documents(
+                [texts[ii] for ii in missing.values()]
+            )
+            embeddings = self._fill(keys, embeddings, missing, new_embeddings)
+
+        return [embedding.tolist() for embedding in embeddings]
+
+    def embed_query(self, text):
+        """Embeds a single query text, reading it from memory if possible."""
+        import numpy as np
+
+        key = _hash_text(text)
+        embedding = self._recall(key)
+        if embedding is None:
+            self.misses += 1
+            embedding = self.embedding_engine.embed_query(text)
+            embedding = np.asarray(embedding, dtype="float32")
+            self._remember(key, embedding)
+        else:
+            self.hits += 1
+
+        return embedding.tolist()
+
+    async def aembed_documents(self, texts):
+        """Embeds a list of texts like embed_documents, without blocking the loop.
+
+        Reads and writes of the cache on disk run in a thread.
+        """
+        keys, embeddings, missing = await asyncio.to_thread(self._lookup, texts)
+        if missing:
+            new_embeddings = await _aembed_documents(
+                self.embedding_engine, [texts[ii] for ii in missing.values()]
+            )
+            embeddings = await asyncio.to_thread(
+                self._fill, keys, embeddings, missing, new_embeddings
+            )
+
+        return [embedding.tolist() for embedding in embeddings]
+
+    def embed_queries(self, texts):
+        """Embeds many query texts in one call, reading them from memory if possible.
+
+        Like embed_query, and unlike embed_documents, never touches the shards.
+        """
+        import numpy as np
+
+        keys = [_hash_text(text) for text in texts]
+        embeddings = [self._recall(key) for key in keys]
+        missing = {}  # key -> index of first text with that key, deduplicated
+        for ii, (key, embedding) in enumerate(zip(keys, embeddings)):
+            if embedding is None:
+                missing.setdefault(key, ii)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_embeddings = self.embedding_engine.embed_documents(
+                [texts[ii] for ii in missing.values()]
+            )
+            new_embeddings = dict(zip(missing, np.asarray(new_embeddings, "float32")))
+            for key, embedding in new_embeddings.items():
+                self._remember(key, embedding)
+            embeddings = [
+                new_embeddings[key] if embedding is None else embedding
+                for key, embedding in zip(keys, embeddings)
+            ]
+
+        return [embedding.tolist() for embedding in embeddings]
+
+    async def aembed_query(self, text):
+        """Embeds a single query text like embed_query, without blocking the loop."""
+        import numpy as np
+
+        key = _hash_text(text)
+        embedding = self._recall(key)
+        if embedding is None:
+            self.misses += 1
+            embedding = await _aembed_documents(self.embedding_engine, [text])
+            embedding = np.asarray(embedding[0], dtype="float32")
+            self._remember(key, embedding)
+        else:
+            self.hits += 1
+
+        return embedding.tolist()
+
+    def _lookup(self, texts):
+        keys = [_hash_text(text) for text in texts]
+        embeddings = [self._recall(key) for key in keys]
+
+        unread = {key for key, e in zip(keys, embeddings) if e is None}
+        if unread - self._locations.keys():  # maybe in shards written since
+            self._scan()
+        found = self._read(unread)
+        embeddings = [
+            found.get(key) if e is None else e for key, e in zip(keys, embeddings)
+        ]
+
+        missing = {}  # key -> index of first text with that key, deduplicated
+        for ii, (key, embedding) in enumerate(zip(keys, embeddings)):
+            if embedding is None:
+                missing.setdefault(key, ii)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        return keys, embeddings, missing
+
+    def _fill(self, keys, embeddings, missing, new_embeddings):
+        new_embeddings = self._write(list(missing), new_embeddings)
+        return [
+            new_embeddings[key] if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
 
-    files = VECTOR_DIR.glob(f"{index_name}.*")
-    if files:
-        for file in files:
-            file.unlink()
-        pretty_log("existing index wiped")
+    def _scan(self):
+        """Reads the keys of shards that haven't been seen yet."""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
 
-    index = FAISS.from_texts(
-        texts=documents, embedding=embedding_engine, metadatas=metadatas
+        for name in names:
+            shard, suffix = os.path.splitext(name)
+            if suffix != ".keys" or shard in self._shards:
+                continue
+            try:
+                keys = (self.cache_dir / name).read_text().split()
+            except OSError:
+                continue
+            with self._lock:
+                self._shards.setdefault(shard, None)  # opened when first read
+                for row, key in enumerate(keys):
+                    self._locations.setdefault(key, (shard, row))
+
+    def _read(self, keys):
+        """Reads embeddings from their shards, one read per shard."""
+        import collections
+
+        import numpy as np
+
+        rows_by_shard = collections.defaultdict(list)
+        for key in keys:
+            if key in self._locations:
+                shard, row = self._locations[key]
+                rows_by_shard[shard].append((row, key))
+
+        found = {}
+        for shard, rows in rows_by_shard.items():
+            try:
+                embeddings = self._open(shard)[np.array([row for row, _ in rows])]
+            except (OSError, ValueError, IndexError):
+                continue
+            for (_, key), embedding in zip(rows, embeddings):
+                found[key] = embedding
+                self._remember(key, embedding)
+
+        return found
+
+    def _open(self, shard):
+        import numpy as np
+
+        embeddings = self._shards.get(shard)
+        if embeddings is None:
+            embeddings = np.load(self.cache_dir / f"{shard}.npy", mmap_mode="r")
+            self._shards[shard] = embeddings
+        return embeddings
+
+    def _write(self, keys, embeddings):
+        """Writes a batch of new embeddings to a new shard, returning them by key."""
+        import uuid
+
+        import numpy as np
+
+        embeddings = np.asarray(embeddings, dtype="float32")
+        shard = uuid.uuid4().hex
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # the keys are written last, so readers only find complete shards
+            for suffix, write in [
+                (".npy", lambda f: np.save(f, embeddings)),
+                (".keys", lambda f: f.write("\n".join(keys).encode("utf-8"))),
+            ]:
+                path = self.cache_dir / f"{shard}{suffix}"
+                tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+                with open(tmp_path, "wb") as f:
+                    write(f)
+                os.replace(tmp_path, path)
+        except OSError as e:  # caching is an optimization, so we don't fail on it
+            pretty_log(f"failed to cache {len(keys)} embeddings: {e}")
+        else:
+            with self._lock:
+                self._shards[shard] = embeddings
+                for row, key in enumerate(keys):
+                    self._locations[key] = (shard, row)
+
+        for key, embedding in zip(keys, embeddings):
+            self._remember(key, embedding)
+        return dict(zip(keys, embeddings))
+
+    def _recall(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+        return embedding
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._memory[key] = embedding
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+
+async def _aembed_documents(embedding_engine, texts):
+    """Embeds texts asynchronously, in a thread if the engine has no async method."""
+    if hasattr(embedding_engine, "aembed_documents"):
+        return await embedding_engine.aembed_documents(texts)
+    return await asyncio.to_thread(embedding_engine.embed_documents, texts)
+
+
+def embed_queries(embedding_engine, texts):
+    """Embeds many queries at once, as documents if the engine has no such method."""
+    if hasattr(embedding_engine, "embed_queries"):
+        return embedding_engine.embed_queries(texts)
+    return embedding_engine.embed_documents(texts)
+
+
+def _hash_text(text):
+    import hashlib
+
+    m = hashlib.sha256()
+    m.update(text.encode("utf-8", "replace"))
+    return m.hexdigest()
+
+
+def _slugify(name):
+    import re
+
+    return re.sub(r"[^a-zA-Z0-9_.-]+", "-", name)
+
+
+def search(vector_index, embedding, k=4, nprobe=None, ef_search=None, filter=None):
+    """Finds the k chunks nearest to a query embedding.
+
+    Approximate indexes trade recall for speed with a search-time knob: nprobe,
+    the number of inverted lists visited by IVF indexes, and ef_search, the size
+    of the candidate list kept by HNSW indexes. If not provided, the values in the
+    index's manifest are used.
+
+    A filter, like {"source_type": "paper"}, restricts the search to chunks whose
+    metadata matches, using the index's precomputed filters.FilterIndex. See
+    filters.FIELDS for the fields that can be filtered on.
+
+    Returns:
+        A list of (Document, score) pairs, where scores are L2 distances.
+    """
+    hits = _search_ids(
+        vector_index, [embedding], k, nprobe=nprobe, ef_search=ef_search, filter=filter
+    )[0]
+
+    return [(_get_document(vector_index, faiss_id), score) for faiss_id, score in hits]
+
+
+def hybrid_search(
+    vector_index, embedding, query, k=4, nprobe=None, ef_search=None, filter=None
+):
+    """Finds the k chunks that best match a query, by meaning and by exact terms.
+
+    The top k chunks by vector search and the top k by BM25 over the index's
+    sparse index are fused with reciprocal rank fusion. Without a sparse index,
+    this is the same as search. Filters apply to both searches.
+
+    Returns:
+        A list of (Document, score) pairs, best first, where scores are L2
+        distances, or None for chunks found only by their terms.
+    """
+    return hybrid_search_batch(
+        vector_index,
+        [embedding],
+        [query],
+        k,
+        nprobe=nprobe,
+        ef_search=ef_search,
+        filter=filter,
+    )[0]
+
+
+def hybrid_search_batch(
+    vector_index, embeddings, queries, k=4, nprobe=None, ef_search=None, filter=None
+):
+    """Runs hybrid_search for many queries, with a single search of the vector index.
+
+    The query embeddings are searched as one matrix, so FAISS can spread them over
+    its threads, and only the BM25 searches, which are cheap, run one at a time.
+
+    Returns:
+        A list of results like those of hybrid_search, one for each query.
+    """
+    dense_hits = _search_ids(
+        vector_index,
+        embeddings,
+        k,
+        nprobe=nprobe,
+        ef_search=ef_search,
+        filter=filter,
+    )
+
+    sparse_index = getattr(vector_index, "sparse_index", None)
+    if sparse_index is None:
+        return [
+            [(_get_document(vector_index, faiss_id), score) for faiss_id, score in hits]
+            for hits in dense_hits
+        ]
+
+    import sparse
+
+    mask = _get_filter_index(vector_index).mask(filter) if filter else None
+    results = []
+    for query, hits in zip(queries, dense_hits):
+        hits = dict(hits)
+        sparse_hits = [faiss_id for faiss_id, _ in sparse_index.search(query, k, mask)]
+        fused = sparse.reciprocal_rank_fusion([list(hits), sparse_hits])[:k]
+        results.append(
+            [
+                (_get_document(vector_index, faiss_id), hits.get(faiss_id))
+                for faiss_id, _ in fused
+            ]
+        )
+
+    return results
+
+
+def _search_ids(vector_index, embeddings, k, nprobe=None, ef_search=None, filter=None):
+    """Searches for a batch of query embeddings, returning (FAISS id, score) lists."""
+    import numpy as np
+
+    selector = _get_filter_index(vector_index).selector(filter) if filter else None
+    params = _search_parameters(
+        vector_index, nprobe=nprobe, ef_search=ef_search, selector=selector
+    )
+    scores, faiss_ids = vector_index.index.search(
+        np.array(embeddings, dtype="float32"), k, params=params
     )
 
+    return [
+        [
+            (int(faiss_id), float(score))
+            for score, faiss_id in zip(row_scores, row_ids)
+            if faiss_id != -1
+        ]
+        for row_scores, row_ids in zip(scores, faiss_ids)
+    ]
+
+
+def _get_filter_index(vector_index):
+    filter_index = getattr(vector_index, "filter_index", None)
+    if filter_index is None:
+        raise ValueError(
+            "this index has no metadata filters, save it again to add them"
+        )
+    return filter_index
+
+
+def _get_document(vector_index, faiss_id):
+    import chunkstore
+
+    if isinstance(vector_index.docstore, chunkstore.ChunkStore):
+        return vector_index.docstore.get(faiss_id)  # skips the docstore id lookup
+    docstore_id = vector_index.index_to_docstore_id[faiss_id]
+    return vector_index.docstore.search(docstore_id)
+
+
+def _search_parameters(vector_index, nprobe=None, ef_search=None, selector=None):
+    import faiss
+
+    index_type = vector_index.manifest["index_type"]
+    params = vector_index.manifest["params"]
+    # search parameters replace all of the index's defaults, so we fill them in
+    if index_type.startswith("ivf-") and (nprobe or selector):
+        return faiss.SearchParametersIVF(
+            nprobe=nprobe or params["nprobe"], sel=selector
+        )
+    if index_type == "hnsw" and (ef_search or selector):
+        return faiss.SearchParametersHNSW(
+            efSearch=ef_search or params["efSearch"], sel=selector
+        )
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def split_documents(documents, skip=(), processes=1):
+    """Lazily splits documents into (id, text, metadata) chunks.
+
+    Each chunk gets an id made from the hash of its document and its position in
+    that document. Documents with the same hash as an earlier one are skipped, as
+    are documents whose hashes are in skip.
+
+    With more than one process, documents are split in windows across a pool of
+    worker processes, each with its own tokenizer. Chunks come out in the same
+    order either way.
+
+    Arguments:
+        documents: An iterable of documents with text, metadata, and a hash ID.
+        skip: A collection of document hashes to leave out.
+        processes: The number of processes to split text with.
+    """
+    import itertools
+
+    documents = _unique_documents(documents, skip)
+
+    if processes <= 1:
+        _init_text_splitter()
+        for document in documents:
+            yield from _to_chunks(document, _split_text(document["text"]))
+        return
+
+    import multiprocessing
+
+    window = processes * SPLIT_WINDOW_PER_PROCESS
+    with multiprocessing.get_context("fork").Pool(
+        processes, initializer=_init_text_splitter
+    ) as pool:
+        while batch := list(itertools.islice(documents, window)):
+            split_texts = pool.map(
+                _split_text, [document["text"] for document in batch], chunksize=4
+            )
+            for document, doc_texts in zip(batch, split_texts):
+                yield from _to_chunks(document, doc_texts)
+
+
+def _unique_documents(documents, skip):
+    seen = set()
+    for document in documents:
+        document_id = document["metadata"].get("sha256")
+        if document_id in seen or document_id in skip:
+            continue
+        seen.add(document_id)
+        yield document
+
+
+def _to_chunks(document, doc_texts):
+    metadata = document["metadata"]
+    document_id = metadata.get("sha256")
+    for ii, chunk_text in enumerate(doc_texts):
+        yield f"{document_id}-{ii}", chunk_text, metadata
+
+
+# each process, including pool workers, holds its own splitter and tokenizer
+_text_splitter = None
+
+
+def _init_text_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, allowed_special="all"
+        )
+
+
+def _split_text(text):
+    return _text_splitter.split_text(text)
+
+
+def create_vector_index(
+    index_name,
+    embedding_engine,
+    chunks,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    index_type=DEFAULT_INDEX_TYPE,
+    index_params=None,
+):
+    """Creates a vector index that offers similarity search.
+
+    The index maps FAISS ids to chunks, so that the chunks of a document can later
+    be removed by its hash. Chunks are embedded and added in batches as they
+    arrive, so memory use is bounded by the batch size, not the corpus size.
+
+    Indexes that need training, the IVF types, are trained on a sample of up to
+    TRAINING_SAMPLE_SIZE vectors from the start of the stream. The type and
+    parameters of the index are recorded in its manifest.
+
+    Arguments:
+        index_name: The name of the index.
+        embedding_engine: The engine used to embed the texts.
+        chunks: An iterable of (id, text, metadata) tuples. Each id is made from
+            the chunk's document's sha256 hash and the chunk's position.
+        batch_size: The number of chunks to embed and add at a time.
+        index_type: One of INDEX_TYPES.
+        index_params: Overrides for the default parameters of the index type.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type must be one of {list(INDEX_TYPES)}")
+    params = dict(INDEX_TYPES[index_type], **(index_params or {}))
+
+    index, added = _add_in_batches(
+        None, embedding_engine, chunks, batch_size, index_type, params
+    )
+    if index is None:
+        raise ValueError(f"no chunks provided for vector index {index_name}")
+    pretty_log(f"created vector index {index_name} with {added} vectors")
+
     return index
+
+
+def is_updatable(vector_index):
+    """Checks whether the chunks in an index can be added and removed by id."""
+    return vector_index.manifest["index_type"] in UPDATABLE_INDEX_TYPES
+
+
+def get_indexed_documents(vector_index):
+    """Maps the hash of each document in an updatable index to its chunks' ids."""
+    indexed = {}
+    for faiss_id, docstore_id in vector_index.index_to_docstore_id.items():
+        document_id = docstore_id.rsplit("-", 1)[0]
+        indexed.setdefault(document_id, []).append(faiss_id)
+
+    return indexed
+
+
+def add_to_vector_index(
+    vector_index, embedding_engine, chunks, batch_size=EMBEDDING_BATCH_SIZE
+):
+    """Embeds (id, text, metadata) chunks and adds them to an updatable index."""
+    _, added = _add_in_batches(vector_index, embedding_engine, chunks, batch_size)
+
+    return added
+
+
+def remove_from_vector_index(vector_index, document_ids):
+    """Removes all chunks of the given documents from an updatable vector index."""
+    import numpy as np
+
+    indexed = get_indexed_documents(vector_index)
+    faiss_ids = [
+        faiss_id
+        for document_id in document_ids
+        for faiss_id in indexed.get(document_id, [])
+    ]
+    if not faiss_ids:
+        return 0
+
+    vector_index.index.remove_ids(np.array(faiss_ids, dtype="int64"))
+    for faiss_id in faiss_ids:
+        docstore_id = vector_index.index_to_docstore_id.pop(faiss_id)
+        vector_index.docstore._dict.pop(docstore_id, None)
+
+    return len(faiss_ids)
+
+
+def _add_in_batches(
+    vector_index, embedding_engine, chunks, batch_size, index_type=None, params=None
+):
+    """Embeds chunks and adds them batch-by-batch, creating the index if needed."""
+    import itertools
+
+    import numpy as np
+
+    chunks, added, held_back = iter(chunks), 0, []
+    train_size = _training_size(index_type, params)
+    start = last_report = time.monotonic()
+    while batch := list(itertools.islice(chunks, batch_size)):
+        ids, texts, metadatas = zip(*batch)
+        embeddings = np.array(embedding_engine.embed_documents(list(texts)), "float32")
+
+        if vector_index is None:  # hold batches back until we can train the index
+            held_back.append((texts, embeddings, metadatas, ids))
+            if sum(len(item[1]) for item in held_back) < train_size:
+                continue
+            vector_index = _new_vector_index(
+                embedding_engine, index_type, params, held_back
+            )
+            batches, held_back = held_back, []
+        else:
+            batches = [(texts, embeddings, metadatas, ids)]
+
+        for batch_args in batches:
+            added += _add_embeddings(vector_index, *batch_args)
+
+        now = time.monotonic()
+        if now - last_report > PROGRESS_INTERVAL:
+            pretty_log(f"indexed {added} chunks, {added / (now - start):.1f} chunks/s")
+            last_report = now
+
+    if held_back:  # the stream was shorter than the training sample
+        vector_index = _new_vector_index(
+            embedding_engine, index_type, params, held_back
+        )
+        for batch_args in held_back:
+            added += _add_embeddings(vector_index, *batch_args)
+
+    elapsed = time.monotonic() - start
+    if added:
+        pretty_log(
+            f"indexed {added} chunks in {elapsed:.1f}s, {added / elapsed:.1f} chunks/s"
+        )
+
+    return vector_index, added
+
+
+def _training_size(index_type, params):
+    if index_type is None or not index_type.startswith("ivf-"):
+        return 0
+    return min(TRAINING_SAMPLE_SIZE, 64 * params["nlist"])
+
+
+def _new_vector_index(embedding_engine, index_type, params, batches):
+    """Creates an empty index of the given type, trained on the batches' vectors."""
+    import math
+
+    import faiss
+    import numpy as np
+    from langchain.docstore.in_memory import InMemoryDocstore
+    from langchain.vectorstores import FAISS
+
+    sample = np.concatenate([embeddings for _, embeddings, _, _ in batches])
+    dimension, params = sample.shape[1], dict(params)
+
+    if index_type.startswith("ivf-"):
+        # fewer lists than requested if the sample is small, ~39 vectors per list
+        params["nlist"] = max(1, min(params["nlist"], len(sample) // 39))
+    if index_type == "ivf-pq":
+        params["m"] = math.gcd(params["m"], dimension)  # subvectors must divide dim
+        max_nbits = int(math.log2(max(2, len(sample) // 39)))
+        params["nbits"] = max(1, min(params["nbits"], max_nbits))
+
+    if index_type == "flat":
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    elif index_type == "ivf-flat":
+        index = faiss.index_factory(dimension, f"IVF{params['nlist']},Flat")
+    elif index_type == "ivf-pq":
+        index = faiss.index_factory(
+            dimension, f"IVF{params['nlist']},PQ{params['m']}x{params['nbits']}"
+        )
+    elif index_type == "hnsw":
+        index = faiss.index_factory(dimension, f"IDMap2,HNSW{params['M']}")
+        faiss.downcast_index(index.index).hnsw.efConstruction = params["efConstruction"]
+
+    if not index.is_trained:
+        pretty_log(f"training {index_type} index on {len(sample)} vectors")
+        index.train(sample)
+
+    vector_index = FAISS(embedding_engine.embed_query, index, InMemoryDocstore({}), {})
+    vector_index.manifest = {
+        "index_type": index_type,
+        "params": params,
+        "dimension": dimension,
+        "embedding_model": getattr(embedding_engine, "model", None),
+    }
+    _apply_search_defaults(vector_index)
+
+    return vector_index
+
+
+def _add_embeddings(vector_index, texts, embeddings, metadatas, ids):
+    """Adds embedded chunks, keyed by their chunk ids, to an updatable index."""
+    import numpy as np
+    from langchain.docstore.document import Document
+
+    docstore_ids = list(ids)
+    faiss_ids = [_to_faiss_id(docstore_id) for docstore_id in docstore_ids]
+
+    vector_index.index.add_with_ids(
+        np.asarray(embeddings, dtype="float32"), np.array(faiss_ids, dtype="int64")
+    )
+    vector_index.docstore.add(
+        {
+            docstore_id: Document(page_content=text, metadata=metadata)
+            for docstore_id, text, metadata in zip(docstore_ids, texts, metadatas)
+        }
+    )
+    vector_index.index_to_docstore_id.update(zip(faiss_ids, docstore_ids))
+
+    return len(faiss_ids)
+
+
+def _to_faiss_id(docstore_id):
+    """Derives a stable, non-negative 63-bit FAISS id from a chunk's docstore id."""
+    return int(_hash_text(docstore_id)[:15], 16)